@@ -1,4 +1,5 @@
 from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
 from linebot import LineBotApi, WebhookHandler
 from linebot.models import MessageEvent, TextMessage, TextSendMessage
 from linebot.models import QuickReply, QuickReplyButton, MessageAction
@@ -7,11 +8,36 @@ from linebot.models import Profile
 from dotenv import load_dotenv
 import os
 from pydantic import BaseModel
-from supabase import create_client, Client
-import yfinance as yf
 import requests
-from bs4 import BeautifulSoup
+import requests.adapters
 import re
+import sys
+import contextlib
+import random
+import ast
+import json
+import functools
+import csv
+import mmap
+import difflib
+import unicodedata
+import uuid
+import zlib
+import hmac
+import html.parser
+import bisect
+import heapq
+import queue
+import socket
+import subprocess
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 
 # .envの読み込み
 load_dotenv()
@@ -23,24 +49,553 @@ app = FastAPI()
 async def root():
     return {"message": "Hello from Render!"}
 
+# 計測用のヒストグラムとカウンタ（/metricsでPrometheus形式で公開する）
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self._counters = {}  # (name, labels) -> value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            data = self._histograms.get(key)
+            if data is None:
+                data = self._histograms[key] = [0] * len(METRIC_BUCKETS) + [0.0, 0]
+            for i, bound in enumerate(METRIC_BUCKETS):
+                if value <= bound:
+                    data[i] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def render(self):
+        def _labels(pairs):
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}" if pairs else ""
+
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+        for name in sorted({name for (name, _), _ in histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (hist_name, labels), data in histograms:
+                if hist_name != name:
+                    continue
+                for bound, count in zip(METRIC_BUCKETS, data):
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {count}")
+                lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {data[-1]}")
+                lines.append(f"{name}_sum{_labels(labels)} {data[-2]}")
+                lines.append(f"{name}_count{_labels(labels)} {data[-1]}")
+        for name in sorted({name for (name, _), _ in counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (counter_name, labels), value in counters:
+                if counter_name == name:
+                    lines.append(f"{name}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+# ブロック内の処理時間を計測する（例外が出たらエラー数も数える）
+@contextlib.contextmanager
+def timed(name: str, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        metrics.inc(name.replace("_seconds", "_errors_total"), **labels)
+        raise
+    finally:
+        metrics.observe(name, time.perf_counter() - started, **labels)
+
+# 外部API呼び出しを計測するラッパー（呼び出し方は元のクライアントと同じ）
+class InstrumentedLineBotApi:
+    def __init__(self, api):
+        self._api = api
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if not callable(attr):
+            return attr
+
+        def _call(*args, **kwargs):
+            with timed("external_call_seconds", service="line", op=name):
+                return attr(*args, **kwargs)
+        return _call
+
+class _InstrumentedQuery:
+    def __init__(self, query, table, op=None):
+        self._query = query
+        self._table = table
+        self._op = op
+
+    def __getattr__(self, name):
+        attr = getattr(self._query, name)
+        if name == "execute":
+            def _execute(*args, **kwargs):
+                with timed("external_call_seconds", service="supabase", op=f"{self._table}.{self._op}"):
+                    return attr(*args, **kwargs)
+            return _execute
+
+        def _chain(*args, **kwargs):
+            op = self._op or (name if name in ("select", "insert", "upsert", "update", "delete") else None)
+            return _InstrumentedQuery(attr(*args, **kwargs), self._table, op)
+        return _chain
+
+class InstrumentedSupabase:
+    def __init__(self, client):
+        self._client = client
+
+    def table(self, name: str):
+        return _InstrumentedQuery(self._client.table(name), name)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+# サンプリングプロファイラ（実行中にPOST /profiler/startで開始し、/profilerで集計を見る）
+# PROFILER_TOKENを設定したときだけ使え、X-Profiler-Tokenヘッダーに同じ値が必要
+PROFILER_TOKEN = os.getenv("PROFILER_TOKEN", "")
+PROFILER_MIN_INTERVAL = 0.001
+
+class SamplingProfiler:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._running = False
+        self._generation = 0  # 停止直後に再開しても古いスレッドが動き続けないようにする
+        self._stacks = {}
+        self.samples = 0
+        self.interval = 0.01
+
+    def start(self, interval: float = 0.01):
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+            self._generation += 1
+            self._stacks = {}
+            self.samples = 0
+            self.interval = min(max(interval, PROFILER_MIN_INTERVAL), 1.0)
+            generation = self._generation
+        threading.Thread(target=self._run, args=(generation,), daemon=True, name="sampling-profiler").start()
+
+    def stop(self):
+        with self._lock:
+            self._running = False
+
+    def _run(self, generation: int):
+        me = threading.get_ident()
+        while self._running and self._generation == generation:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < 30:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                    frame = frame.f_back
+                key = ";".join(reversed(stack))
+                with self._lock:
+                    self._stacks[key] = self._stacks.get(key, 0) + 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def report(self, top: int = 30):
+        with self._lock:
+            stacks = sorted(self._stacks.items(), key=lambda kv: kv[1], reverse=True)[:top]
+        return {
+            "running": self._running,
+            "interval": self.interval,
+            "samples": self.samples,
+            "stacks": [{"count": count, "stack": stack} for stack, count in stacks],
+        }
+
+profiler = SamplingProfiler()
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+def _profiler_authorized(request: Request):
+    token = request.headers.get("X-Profiler-Token", "")
+    return bool(PROFILER_TOKEN) and hmac.compare_digest(token.encode(), PROFILER_TOKEN.encode())
+
+def _profiler_forbidden():
+    return PlainTextResponse("forbidden", status_code=403)
+
+@app.post("/profiler/start")
+async def profiler_start(request: Request, interval: float = 0.01):
+    if not _profiler_authorized(request):
+        return _profiler_forbidden()
+    profiler.start(interval)
+    return {"status": "started", "interval": profiler.interval}
+
+@app.post("/profiler/stop")
+async def profiler_stop(request: Request):
+    if not _profiler_authorized(request):
+        return _profiler_forbidden()
+    profiler.stop()
+    return profiler.report()
+
+@app.get("/profiler")
+async def profiler_report(request: Request, top: int = 30):
+    if not _profiler_authorized(request):
+        return _profiler_forbidden()
+    return profiler.report(top)
+
+# 最初に使われたときにクライアントを作る（起動直後に重い初期化をしない）
+class LazyClient:
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+# yfinance（pandasも読み込まれる）は最初に株価を取得するときに読み込む
+yf = None
+
+def get_yf():
+    global yf
+    if yf is None:
+        import yfinance
+        yf = yfinance
+    return yf
+
+def _create_supabase_client():
+    from supabase import create_client
+    return InstrumentedSupabase(create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY")))
+
 # Supabaseクライアントの初期化
-supabase: Client = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
+supabase = LazyClient(_create_supabase_client)
 
 class UserRegister(BaseModel):
     line_user_id: str
     experience: str
 
 # LINE APIの初期化
-line_bot_api = LineBotApi(os.getenv("LINE_CHANNEL_ACCESS_TOKEN"))
+line_bot_api = LazyClient(lambda: InstrumentedLineBotApi(LineBotApi(os.getenv("LINE_CHANNEL_ACCESS_TOKEN"))))
 handler = WebhookHandler(os.getenv("LINE_CHANNEL_SECRET"))
 
-user_latest_ticker = {}
+# TTL付き・件数上限ありのLRUキャッシュ（スレッドセーフ）
+class TTLCache:
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    # 期限を延ばさずに値だけを差し替える（期限切れ・未登録なら何もしない）
+    def replace(self, key, value):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                return False
+            self._data[key] = (item[0], value)
+            return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
 
+# 同じキーの同時取得を1回にまとめる（single-flight）
+class SingleFlight:
+    def __init__(self):
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+        if not leader:
+            return future.result()
+        try:
+            future.set_result(fn())
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+        return future.result()
+
+# 会話の途中状態（直前に選んだ銘柄など）を保存するストア
+SESSION_TTL = float(os.getenv("SESSION_TTL", "86400"))
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", "100000"))
+
+# プロセス内だけで共有するストア（ワーカーが1つのとき用）
+class MemorySessionStore:
+    def __init__(self, ttl: float, maxsize: int):
+        self._cache = TTLCache(ttl, maxsize)
+
+    def get(self, key: str):
+        return self._cache.get(key)
+
+    def set(self, key: str, value: str):
+        self._cache.set(key, value)
+
+    def delete(self, key: str):
+        self._cache.pop(key)
+
+# SQLite（WALモード）のファイルで同じマシンの複数ワーカー間で共有するストア
+class SQLiteSessionStore:
+    def __init__(self, path: str, ttl: float, maxsize: int):
+        self.path = path
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._local = threading.local()
+        self._writes = 0
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS session_state ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS session_state_updated_at ON session_state (updated_at)")
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str):
+        row = self._conn().execute(
+            "SELECT value FROM session_state WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str):
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "INSERT INTO session_state (key, value, expires_at, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value, "
+                "expires_at = excluded.expires_at, updated_at = excluded.updated_at",
+                (key, value, now + self.ttl, now),
+            )
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self.evict()
+
+    def delete(self, key: str):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM session_state WHERE key = ?", (key,))
+
+    # 期限切れの行を消し、件数の上限を超えた分は古いものから消す
+    def evict(self):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM session_state WHERE expires_at <= ?", (time.time(),))
+            conn.execute(
+                "DELETE FROM session_state WHERE key IN ("
+                "SELECT key FROM session_state ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+                (self.maxsize,),
+            )
+
+# Supabaseのsession_stateテーブルで複数ノード間で共有するストア
+class SupabaseSessionStore:
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._writes = 0
+
+    def get(self, key: str):
+        rows = supabase.table("session_state").select("value").eq("key", key).gt(
+            "expires_at", datetime.now(timezone.utc).isoformat()
+        ).execute().data
+        return rows[0]["value"] if rows else None
+
+    def set(self, key: str, value: str):
+        now = datetime.now(timezone.utc)
+        supabase.table("session_state").upsert({
+            "key": key,
+            "value": value,
+            "expires_at": (now + timedelta(seconds=self.ttl)).isoformat(),
+        }, on_conflict="key").execute()
+        self._writes += 1
+        if self._writes % 100 == 0:
+            supabase.table("session_state").delete().lt("expires_at", now.isoformat()).execute()
+
+    def delete(self, key: str):
+        supabase.table("session_state").delete().eq("key", key).execute()
+
+# SESSION_STORE=memory（既定） / sqlite:<ファイルのパス> / supabase
+def create_session_store():
+    backend = os.getenv("SESSION_STORE", "memory")
+    if backend.startswith("sqlite:"):
+        return SQLiteSessionStore(backend[len("sqlite:"):], SESSION_TTL, SESSION_MAX_ENTRIES)
+    if backend == "supabase":
+        return SupabaseSessionStore(SESSION_TTL)
+    return MemorySessionStore(SESSION_TTL, SESSION_MAX_ENTRIES)
+
+session_store = create_session_store()
+
+def get_latest_ticker(line_user_id: str):
+    return session_store.get(f"latest_ticker:{line_user_id}")
+
+def set_latest_ticker(line_user_id: str, ticker: str):
+    session_store.set(f"latest_ticker:{line_user_id}", ticker)
+
+# 通知チェックをバックグラウンドで開始し、進み具合を返す（実行中なら現在の進み具合を返す）
 @app.get("/run-check")
 async def run_check():
-    check_and_send_notifications()
-    return {"status": "通知チェック完了です！"}
+    global check_progress
+    if not check_lock.acquire(blocking=False):
+        return {"status": "通知チェック実行中です", **_check_progress_snapshot()}
+    check_progress = {"run_id": uuid.uuid4().hex, "worker": WORKER_ID, "started_at": time.time()}
+    threading.Thread(target=_run_check_in_background, args=(check_progress,), daemon=True).start()
+    return {"status": "通知チェックを開始しました", **_check_progress_snapshot()}
+
+@app.get("/run-check/status")
+async def run_check_status():
+    return _check_progress_snapshot()
+
+# 実行中のチェックが書き換えている途中でも返せるようにコピーする
+def _check_progress_snapshot():
+    snapshot = dict(check_progress)
+    if "shards" in snapshot:
+        snapshot["shards"] = dict(snapshot["shards"])
+    return snapshot
+
+# Webhookイベントを登録済みのハンドラに振り分ける（WebhookHandler.handleと同じキーで検索）
+def dispatch_event(event):
+    func = None
+    if isinstance(event, MessageEvent):
+        func = handler._handlers.get(f"{type(event).__name__}_{type(event.message).__name__}")
+    if func is None:
+        func = handler._handlers.get(type(event).__name__)
+    if func is None:
+        print("ハンドラが登録されていないイベント:", type(event).__name__)
+        return
+    func(event)
+
+# Webhookイベントの処理キュー
+# ユーザーごとに同じレーンへ振り分けるので、同じユーザーのイベントは順番通りに処理され、
+# 別ユーザーのイベントは別レーンで並列に処理される
+class WebhookWorkerPool:
+    def __init__(self, workers: int, maxsize: int):
+        self._queues = [queue.Queue(maxsize=maxsize) for _ in range(workers)]
+        self._busy_seconds = [0.0] * workers
+        self._busy = [False] * workers
+        self._started_at = None
+        self._lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def start(self):
+        if self._started_at is not None:
+            return
+        self._started_at = time.monotonic()
+        for i in range(len(self._queues)):
+            threading.Thread(target=self._run, args=(i,), daemon=True, name=f"webhook-worker-{i}").start()
+
+    def submit(self, event):
+        user_id = getattr(getattr(event, "source", None), "user_id", None) or ""
+        lane = hash(user_id) % len(self._queues)
+        try:
+            self._queues[lane].put_nowait(event)
+            return True
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            print("Webhookキューが満杯のためイベントを破棄しました:", user_id)
+            return False
+
+    def _run(self, i):
+        q = self._queues[i]
+        while True:
+            event = q.get()
+            self._busy[i] = True
+            started = time.monotonic()
+            try:
+                dispatch_event(event)
+                with self._lock:
+                    self.processed += 1
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                print("LINE webhook error:", e)
+            finally:
+                self._busy_seconds[i] += time.monotonic() - started
+                self._busy[i] = False
+                q.task_done()
+
+    def stats(self):
+        uptime = time.monotonic() - self._started_at if self._started_at else 0.0
+        return {
+            "workers": len(self._queues),
+            "busy_workers": sum(self._busy),
+            "queue_depth": sum(q.qsize() for q in self._queues),
+            "max_lane_depth": max(q.qsize() for q in self._queues),
+            "utilization": (sum(self._busy_seconds) / (uptime * len(self._queues))) if uptime else 0.0,
+            "processed": self.processed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+        }
+
+webhook_pool = WebhookWorkerPool(
+    int(os.getenv("WEBHOOK_WORKERS", "8")),
+    int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000")),
+)
+
+@app.on_event("startup")
+def start_webhook_workers():
+    webhook_pool.start()
+
+@app.get("/webhook-stats")
+async def webhook_stats():
+    return webhook_pool.stats()
 
+# 署名を検証してイベントをキューに積み、すぐに200を返す（処理はワーカーで行う）
 @app.post("/callback")
 async def callback(request: Request):
     signature = request.headers["X-Line-Signature"]
@@ -48,57 +603,405 @@ async def callback(request: Request):
     body_str = body.decode("utf-8")
 
     try:
-        handler.handle(body_str, signature)
+        events = handler.parser.parse(body_str, signature)
     except Exception as e:
         print("LINE webhook error:", e)
         return {"status": "error"}
 
+    webhook_pool.start()
+    for event in events:
+        webhook_pool.submit(event)
+
     return {"status": "ok"}
 
 
-# Yahooファイナンスから証券コード候補リストを取得（日本株優先、なければ海外株も探索）
-def get_ticker_candidates(company_name: str):
-    candidates = []
-    seen = set()
-    headers = {"User-Agent": "Mozilla/5.0"}
-
-    # 日本株（Yahoo!ファイナンス日本語サイト）
-    search_url_jp = f"https://finance.yahoo.co.jp/search/?query={company_name}"
-    res = requests.get(search_url_jp, headers=headers)
-    soup = BeautifulSoup(res.text, "lxml")
-    for h2 in soup.select("h2.SearchItem__name__1ApM"):
-        a = h2.find_parent("a", href=True)
-        if a and "/quote/" in a["href"]:
-            ticker = a["href"].split("/quote/")[-1]
-            name = h2.text.strip()
+# 検索キーの正規化（全角/半角・大文字/小文字・カタカナ/ひらがなの揺れを吸収）
+def normalize_symbol_key(text: str):
+    text = unicodedata.normalize("NFKC", text).lower()
+    for word in ("株式会社", "(株)", "ホールディングス", "holdings", "inc.", "corporation", "corp."):
+        text = text.replace(word, "")
+    text = "".join(chr(ord(c) - 0x60) if "ァ" <= c <= "ヶ" else c for c in text)
+    return re.sub(r"[\s・.,'\-]", "", text)
+
+# 事前に作成した銘柄辞書（日本株・米国株）をmmapで読み込み、前方一致・あいまい検索する
+# ファイル形式: 正規化済みキーでソートされた「キー\tティッカー\t表示名\n」のUTF-8テキスト
+class SymbolIndex:
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._offsets = array("Q")
+        pos = 0
+        size = len(self._mm)
+        while pos < size:
+            self._offsets.append(pos)
+            end = self._mm.find(b"\n", pos)
+            pos = size if end == -1 else end + 1
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def _line(self, i):
+        start = self._offsets[i]
+        end = self._mm.find(b"\n", start)
+        return self._mm[start:end if end != -1 else len(self._mm)].decode("utf-8")
+
+    def _key(self, i):
+        return self._line(i).split("\t", 1)[0]
+
+    def _lower_bound(self, key):
+        lo, hi = 0, len(self._offsets)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _prefix_range(self, prefix):
+        start = self._lower_bound(prefix)
+        end = start
+        while end < len(self._offsets) and self._key(end).startswith(prefix):
+            end += 1
+        return start, end
+
+    def search(self, query: str, limit: int = 5):
+        key = normalize_symbol_key(query)
+        if not key:
+            return []
+        results = []
+        seen = set()
+
+        def _add(i):
+            _, ticker, name = self._line(i).split("\t")
             if ticker not in seen:
-                trimmed_name = name[:20]  # LINEの制限に合わせて最大20文字に切り詰め
-                candidates.append((ticker, trimmed_name))
+                results.append((ticker, name[:20]))
                 seen.add(ticker)
+
+        # 前方一致（完全一致が先頭に来る）
+        start, end = self._prefix_range(key)
+        for i in range(start, end):
+            _add(i)
+            if len(results) >= limit:
+                return results
+
+        # 前方一致がなければ先頭1文字が同じキーの中からあいまい検索
+        if not results:
+            start, end = self._prefix_range(key[0])
+            keys = {self._key(i): i for i in range(start, end)}
+            for match in difflib.get_close_matches(key, list(keys), n=limit, cutoff=0.6):
+                _add(keys[match])
+        return results[:limit]
+
+# CSV（ticker,name,aliases）から銘柄辞書を作る。aliasesは「|」区切りでかな・ローマ字などの別名
+def build_symbol_index(src_path: str, out_path: str):
+    rows = set()
+    with open(src_path, encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            ticker = row["ticker"].strip()
+            name = row["name"].strip()
+            for alias in [name, ticker] + (row.get("aliases") or "").split("|"):
+                key = normalize_symbol_key(alias)
+                if key:
+                    rows.add((key, ticker, name))
+    with open(out_path, "w", encoding="utf-8", newline="\n") as f:
+        for key, ticker, name in sorted(rows):
+            f.write(f"{key}\t{ticker}\t{name}\n")
+    return len(rows)
+
+def load_symbol_index():
+    path = os.getenv("SYMBOL_INDEX_PATH", "symbols.idx")
+    if not os.path.exists(path):
+        print(f"銘柄辞書が見つかりません（{path}）。Yahoo検索のみを使用します")
+        return None
+    index = SymbolIndex(path)
+    print(f"銘柄辞書を読み込みました: {len(index)}件")
+    return index
+
+symbol_index = load_symbol_index()
+
+# Yahoo検索結果のキャッシュ（同じ企業名の再検索を省く）
+candidate_cache = TTLCache(
+    float(os.getenv("CANDIDATE_CACHE_TTL", "86400")),
+    int(os.getenv("CANDIDATE_CACHE_SIZE", "1000")),
+)
+
+# 証券コード候補リストを取得（銘柄辞書 → キャッシュ → Yahoo検索の順）
+def get_ticker_candidates(company_name: str):
+    if symbol_index is not None:
+        candidates = symbol_index.search(company_name)
+        if candidates:
+            return candidates
+
+    cache_key = normalize_symbol_key(company_name) or company_name
+    candidates = candidate_cache.get(cache_key)
+    if candidates is None:
+        candidates = search_ticker_candidates(company_name)
+        if candidates:
+            candidate_cache.set(cache_key, candidates)
+    return candidates
+
+# 外部HTTP用の共有セッション（keep-aliveで接続を使い回す）
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "5"))
+SEARCH_DEADLINE = float(os.getenv("SEARCH_DEADLINE", "3"))
+http_session = requests.Session()
+http_session.headers.update({"User-Agent": "Mozilla/5.0"})
+_http_adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=32)
+http_session.mount("https://", _http_adapter)
+http_session.mount("http://", _http_adapter)
+
+# 候補検索を並列に実行するスレッドプール（プロセス全体で共有）
+search_pool = ThreadPoolExecutor(max_workers=int(os.getenv("SEARCH_WORKERS", "16")))
+
+# 日本株（Yahoo!ファイナンス日本語サイト）
+# Yahoo!ファイナンスの検索結果ページから候補だけを抜き出すパーサー
+# ページ全体のツリーは作らず、/quote/へのリンク内のh2だけを読んで上限件数に達したら止める
+# クラス名のハッシュ部分（SearchItem__name__1ApMの1ApM）が変わっても、リンク内のh2なら候補として扱う
+class JpSearchResultParser(html.parser.HTMLParser):
+    def __init__(self, limit: int = 5):
+        super().__init__()
+        self.limit = limit
+        self.candidates = []
+        self._seen = set()  # 同じ銘柄へのリンクが複数あっても1件として数える
+        self._href = None
+        self._name = None
+        self._h2_depth = 0
+
+    @property
+    def done(self):
+        return len(self.candidates) >= self.limit
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "a":
+            href = dict(attrs).get("href") or ""
+            self._href = href if "/quote/" in href else None
+            self._name = None
+            self._h2_depth = 0
+        elif tag == "h2" and self._href is not None:
+            # リンク内の最初のh2だけを銘柄名として読む（後ろのコードや株価は含めない）
+            if self._h2_depth:
+                self._h2_depth += 1
+            elif self._name is None:
+                self._name = []
+                self._h2_depth = 1
+
+    def handle_data(self, data):
+        if self._h2_depth:
+            self._name.append(data)
+
+    def handle_endtag(self, tag):
+        if tag == "h2" and self._h2_depth:
+            self._h2_depth -= 1
+        elif tag == "a" and self._href is not None:
+            name = "".join(self._name or []).strip()
+            ticker = self._href.split("/quote/")[-1]
+            if name and ticker not in self._seen and not self.done:
+                self._seen.add(ticker)
+                self.candidates.append((ticker, name[:20]))  # LINEの制限に合わせて最大20文字に切り詰め
+            self._href = None
+            self._name = None
+            self._h2_depth = 0
+
+def parse_jp_search_results(text: str, limit: int = 5, chunk_size: int = 8192):
+    parser = JpSearchResultParser(limit)
+    for start in range(0, len(text), chunk_size):
+        parser.feed(text[start:start + chunk_size])
+        if parser.done:
+            break
+    return parser.candidates
+
+def search_jp_candidates(company_name: str):
+    search_url_jp = "https://finance.yahoo.co.jp/search/"
+    with timed("external_call_seconds", service="yahoo", op="search_jp"):
+        res = http_session.get(search_url_jp, params={"query": company_name}, timeout=HTTP_TIMEOUT)
+    with timed("parse_seconds", op="search_jp"):
+        return parse_jp_search_results(res.text)
+
+# 海外株（Yahoo! finance search API）
+def search_global_candidates(company_name: str):
+    candidates = []
+    search_url = "https://query2.finance.yahoo.com/v1/finance/search"
+    with timed("external_call_seconds", service="yahoo", op="search_global"):
+        res = http_session.get(search_url, params={"q": company_name}, timeout=HTTP_TIMEOUT)
+    data = res.json()
+    for item in data.get("quotes", []):
+        symbol = item.get("symbol")
+        name = item.get("shortname") or item.get("longname") or item.get("name")
+        exch_disp = item.get("exchDisp", "")
+        if item.get("quoteType") == "EQUITY" and symbol and name:
+            label = f"{name}（{symbol} / {exch_disp}）" if exch_disp else f"{name}（{symbol}）"
+            label = label[:20]  # LINEのquickReplyの制限で20文字以内にトリミング
+            candidates.append((symbol, label))
         if len(candidates) >= 5:
             break
+    return candidates
 
-    # 海外株（Yahoo! finance search API）
-    try:
-        search_url = f"https://query2.finance.yahoo.com/v1/finance/search?q={company_name}"
-        res = requests.get(search_url, headers=headers)
-        data = res.json()
-        for item in data.get("quotes", []):
-            symbol = item.get("symbol")
-            name = item.get("shortname") or item.get("longname") or item.get("name")
-            exch_disp = item.get("exchDisp", "")
-            if item.get("quoteType") == "EQUITY" and symbol and name and symbol not in seen:
-                label = f"{name}（{symbol} / {exch_disp}）" if exch_disp else f"{name}（{symbol}）"
-                label = label[:20]  # LINEのquickReplyの制限で20文字以内にトリミング
-                candidates.append((symbol, label))
-                seen.add(symbol)
+# Yahooファイナンスから証券コード候補リストを取得（日本株優先、なければ海外株も探索）
+# 日本株・海外株の検索は並列に実行し、期限までに返ってきた結果だけを使う
+def search_ticker_candidates(company_name: str):
+    futures = [
+        search_pool.submit(search_jp_candidates, company_name),
+        search_pool.submit(search_global_candidates, company_name),
+    ]
+    deadline = time.monotonic() + SEARCH_DEADLINE
+
+    candidates = []
+    seen = set()
+    for future in futures:
+        try:
+            results = future.result(timeout=max(0, deadline - time.monotonic()))
+        except TimeoutError:
+            print(f"候補検索がタイムアウトしました: {company_name}")
+            continue
+        except Exception as e:
+            print("候補検索失敗:", e)
+            continue
+        for ticker, name in results:
+            if ticker not in seen:
+                candidates.append((ticker, name))
+                seen.add(ticker)
             if len(candidates) >= 5:
-                break
-    except Exception:
-        pass
+                return candidates
 
     return candidates
 
+# LINEプロフィール・ユーザー情報のキャッシュ
+profile_cache = TTLCache(float(os.getenv("PROFILE_CACHE_TTL", "3600")), int(os.getenv("PROFILE_CACHE_SIZE", "10000")))
+user_cache = TTLCache(float(os.getenv("USER_CACHE_TTL", "3600")), int(os.getenv("USER_CACHE_SIZE", "10000")))
+
+# 表示名を取得する（キャッシュになければLINEから取得）
+def get_user_name(line_user_id: str):
+    user_name = profile_cache.get(line_user_id)
+    if user_name is not None:
+        return user_name
+    try:
+        profile = line_bot_api.get_profile(line_user_id)
+        user_name = profile.display_name
+    except Exception as e:
+        print("プロフィール取得失敗:", e)
+        return "未設定"
+    profile_cache.set(line_user_id, user_name)
+    return user_name
+
+# Supabaseへの書き込みを短い間隔でまとめて送る（同じキーへのupsertは最後の1件だけ送る）
+class WriteBuffer:
+    def __init__(self, interval: float, max_attempts: int = 5):
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # 送信中の書き込みが終わるまで次のflushを待たせる
+        self._upserts = {}  # (table, on_conflict) -> {key: (row, 失敗回数)}
+        self._inserts = {}  # table -> [(row, 失敗回数)...]
+        self._on_inserted = {}  # table -> callback(row)
+        self._started = False
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._run, daemon=True, name="write-buffer").start()
+
+    def upsert(self, table: str, row: dict, on_conflict: str):
+        self.start()
+        with self._lock:
+            self._upserts.setdefault((table, on_conflict), {})[row[on_conflict]] = (row, 0)
+
+    def insert(self, table: str, row: dict, on_inserted=None):
+        self.start()
+        with self._lock:
+            self._inserts.setdefault(table, []).append((row, 0))
+            if on_inserted is not None:
+                self._on_inserted[table] = on_inserted
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print("書き込みバッファのflushに失敗しました:", e)
+
+    # 溜まっている書き込みをすぐに送る（削除や一覧取得の前にも呼ぶ）
+    def flush(self):
+        with self._flush_lock:
+            self._flush()
+
+    # まとめて送り、失敗したら1行ずつ送り直す。失敗した行は次のflushで再送し、max_attempts回失敗したら捨てる
+    def _write(self, table: str, entries, send):
+        try:
+            return send([row for row, _ in entries]) or [], []
+        except Exception as e:
+            print(f"{table}への書き込みに失敗しました（{len(entries)}行）:", e)
+            if len(entries) == 1:
+                failed = entries
+                written = []
+            else:
+                written, failed = [], []
+                for entry in entries:
+                    try:
+                        written += send([entry[0]]) or []
+                    except Exception as row_error:
+                        print(f"{table}への書き込みに失敗しました:", row_error)
+                        failed.append(entry)
+        retry = []
+        for row, attempts in failed:
+            if attempts + 1 >= self.max_attempts:
+                print(f"{table}への書き込みを{self.max_attempts}回失敗したため破棄します:", row)
+                metrics.inc("write_buffer_dropped_total", table=table)
+            else:
+                retry.append((row, attempts + 1))
+        return written, retry
+
+    def _flush(self):
+        with self._lock:
+            upserts, self._upserts = self._upserts, {}
+            inserts, self._inserts = self._inserts, {}
+        for (table, on_conflict), rows in upserts.items():
+            send = lambda batch: supabase.table(table).upsert(batch, on_conflict=on_conflict).execute().data
+            _, retry = self._write(table, list(rows.values()), send)
+            if retry:
+                with self._lock:
+                    pending = self._upserts.setdefault((table, on_conflict), {})
+                    for row, attempts in retry:
+                        pending.setdefault(row[on_conflict], (row, attempts))
+        for table, rows in inserts.items():
+            send = lambda batch: supabase.table(table).insert(batch).execute().data
+            inserted, retry = self._write(table, rows, send)
+            if retry:
+                with self._lock:
+                    self._inserts[table] = retry + self._inserts.get(table, [])
+            callback = self._on_inserted.get(table)
+            for row in inserted if callback is not None else []:
+                try:
+                    callback(row)
+                except Exception as e:
+                    print(f"{table}への書き込み後の処理に失敗しました:", e)
+
+write_buffer = WriteBuffer(float(os.getenv("WRITE_FLUSH_INTERVAL", "1")), int(os.getenv("WRITE_MAX_ATTEMPTS", "5")))
+
+@app.on_event("startup")
+def start_write_buffer():
+    write_buffer.start()
+
+# 停止時（Renderのスピンダウンなど）に溜まっている書き込みを送っておく
+@app.on_event("shutdown")
+def flush_write_buffer():
+    write_buffer.flush()
+
+# ユーザー情報を保存する（内容が変わっていなければ書き込まない）
+def save_user(line_user_id: str, **fields):
+    row = {"line_user_id": line_user_id, **fields}
+    if user_cache.get(line_user_id) == row:
+        return
+    user_cache.set(line_user_id, row)
+    write_buffer.upsert("users", row, on_conflict="line_user_id")
+
+# 保存された通知設定を手元のコピーとしきい値インデックスに反映する
+def track_notification(row: dict):
+    notification_mirror.add(row)
+    threshold_index.add(row)
+
 # フォローイベントのハンドラを追加
 @handler.add(FollowEvent)
 def handle_follow(event):
@@ -114,6 +1017,8 @@ def handle_follow(event):
         )
     )
     line_bot_api.reply_message(event.reply_token, reply)
+    # 後続のメッセージで使うプロフィールを先に取得しておく
+    get_user_name(event.source.user_id)
 
 # 初心者向けの説明メッセージを定数として定義
 BEGINNER_GUIDE = (
@@ -147,22 +1052,10 @@ def handle_message(event):
     print("受信したテキスト:", text)
     line_user_id = event.source.user_id
 
-    # ユーザーのプロフィール取得
-    try:
-        profile = line_bot_api.get_profile(line_user_id)
-        user_name = profile.display_name
-    except Exception as e:
-        print("プロフィール取得失敗:", e)
-        user_name = "未設定"
-
     if text.startswith("レベル:"):
         level = text.replace("レベル:", "")
         # Supabaseに保存
-        supabase.table("users").upsert({
-            "line_user_id": line_user_id,
-            "name": user_name,
-            "experience": level,
-        }, on_conflict=["line_user_id"]).execute()
+        save_user(line_user_id, name=get_user_name(line_user_id), experience=level)
 
         print(f"{level}が押されました")
         confirm_message = "投資の基本的な説明を聞きますか？"
@@ -212,13 +1105,13 @@ def handle_message(event):
             ticker = text.replace("通知設定:", "")
             line_bot_api.reply_message(
                 event.reply_token,
-                TextSendMessage(text="通知の条件を下記のように入力してください！\n\n【時間ベースが良い時】\n・毎日5時\n・毎週木曜の17時4分\n・毎月23日の0時\n【変動ベースが良い時】\n・5%上がった時\n・25%上がった時\n・株価が5000円を超えた時\n・株価が1600円を下回った時")
+                TextSendMessage(text="通知の条件を下記のように入力してください！\n\n【時間ベースが良い時】\n・毎日5時\n・毎週木曜の17時4分\n・毎月23日の0時\n【変動ベースが良い時】\n・5%上がった時\n・25%上がった時\n・株価が5000円を超えた時\n・株価が1600円を下回った時\n【短期の値動きが良い時】\n・1時間で3%上がった時\n・30分以内に2%下がった時\n・60分移動平均を上抜けた時")
             )
             return
         # 通知条件の受信時
-        elif text.startswith("毎") or ("上が" in text) or ("下が" in text) or ("円を超え" in text) or ("円を下回" in text):
+        elif text.startswith("毎") or ("上が" in text) or ("下が" in text) or ("円を超え" in text) or ("円を下回" in text) or ("移動平均" in text):
             condition = parse_notification_condition(text)
-            ticker = user_latest_ticker.get(line_user_id)
+            ticker = get_latest_ticker(line_user_id)
             if not ticker:
                 line_bot_api.reply_message(
                     event.reply_token,
@@ -226,13 +1119,13 @@ def handle_message(event):
                 )
                 return
             # Supabaseに通知設定を保存
-            supabase.table("notifications").insert({
+            write_buffer.insert("notifications", {
                 "line_user_id": line_user_id,
                 "condition_type": condition.get("type"),
-                "condition_detail": str(condition),
+                "condition_detail": json.dumps(condition, ensure_ascii=False),
                 "ticker": ticker,  # add the ticker to enable checking
-                "user_name": user_name
-            }).execute()
+                "user_name": get_user_name(line_user_id)
+            }, on_inserted=track_notification)
 
             line_bot_api.reply_message(
                 event.reply_token,
@@ -251,7 +1144,11 @@ def handle_message(event):
         # 通知取り消し選択肢表示
         elif text == "通知取り消し選択":
             # 登録済み企業リストを取得
-            notifications = supabase.table("notifications").select("ticker").eq("line_user_id", line_user_id).execute().data
+            write_buffer.flush()
+            notifications = (
+                supabase.table("notifications").select("ticker")
+                .eq("line_user_id", line_user_id).is_("deleted_at", "null").execute().data
+            )
             # 企業コードのペアを収集（value, label両方にtickerを使う）
             ticker_names = [(n["ticker"], n["ticker"]) for n in notifications if "ticker" in n]
             ticker_names = list(set(ticker_names))  # 重複除去
@@ -269,7 +1166,10 @@ def handle_message(event):
 
         elif text.startswith("通知取消:"):
             ticker = text.replace("通知取消:", "")
-            supabase.table("notifications").delete().eq("line_user_id", line_user_id).eq("ticker", ticker).execute()
+            write_buffer.flush()
+            delete_notifications(line_user_id, ticker)
+            threshold_index.remove_user(line_user_id, ticker)
+            window_evaluator.remove_user(line_user_id, ticker)
             line_bot_api.reply_message(event.reply_token, TextSendMessage(
                 text=f"{ticker} の通知設定を取り消しました！"
             ))
@@ -287,8 +1187,12 @@ def handle_message(event):
             return
 
         elif text == "リセット確認:はい":
-            supabase.table("notifications").delete().eq("line_user_id", line_user_id).execute()
+            write_buffer.flush()
+            delete_notifications(line_user_id)
+            threshold_index.remove_user(line_user_id)
+            window_evaluator.remove_user(line_user_id)
             supabase.table("users").delete().eq("line_user_id", line_user_id).execute()
+            user_cache.pop(line_user_id)
 
             line_bot_api.push_message(line_user_id, TextSendMessage(
                 text="登録情報を全て削除しました！\nはじめからやり直します！"
@@ -321,7 +1225,7 @@ def handle_message(event):
         else:
             if text.startswith("候補:"):
                 ticker = text.replace("候補:", "")
-                user_latest_ticker[line_user_id] = ticker
+                set_latest_ticker(line_user_id, ticker)
             else:
                 candidates = get_ticker_candidates(text)
                 if not candidates:
@@ -347,12 +1251,11 @@ def handle_message(event):
                     )
                     return
 
-            user_latest_ticker[line_user_id] = ticker
+            set_latest_ticker(line_user_id, ticker)
 
             detail_url = f"https://finance.yahoo.co.jp/quote/{ticker}"
             try:
-                stock = yf.Ticker(ticker)
-                info = stock.info
+                info = fetch_quote(ticker)
 
                 reply_text = (
                     f"【{ticker}】\n"
@@ -405,6 +1308,18 @@ def parse_notification_condition(text: str):
         if match:
             return {"type": "monthly", "day": int(match[1]), "time": f"{match[2]}時{match[3] if match[3] else '00'}分"}
 
+    # 期間内の変動通知（例: 1時間で3%上がった時、30分以内に2%下がった時）
+    elif re.search(r"\d+(時間|分).*\d+%.*(上が|下が)", text):
+        match = re.search(r"(\d+)(時間|分).*?(\d+)%", text)
+        minutes = int(match[1]) * (60 if match[2] == "時間" else 1)
+        return {"type": "window_up" if "上が" in text else "window_down", "percent": int(match[3]), "minutes": minutes}
+
+    # 移動平均との交差（例: 60分移動平均を上抜けた時、1時間移動平均を下抜けた時）
+    elif "移動平均" in text and ("上抜" in text or "下抜" in text):
+        match = re.search(r"(\d+)(時間|分)", text)
+        minutes = int(match[1]) * (60 if match[2] == "時間" else 1) if match else 60
+        return {"type": "ma_cross_up" if "上抜" in text else "ma_cross_down", "minutes": minutes}
+
     # 上昇変動通知（%）
     elif re.search(r"\d+%.*上が", text):
         percent = re.search(r"(\d+)%", text).group(1)
@@ -427,56 +1342,1094 @@ def parse_notification_condition(text: str):
 
     return {"type": "unknown"}
 
-def check_and_send_notifications():
-    from datetime import datetime
-    from zoneinfo import ZoneInfo
+# 株価取得の並列数（Yahooへの同時接続数の上限）
+QUOTE_FETCH_WORKERS = int(os.getenv("QUOTE_FETCH_WORKERS", "8"))
 
-    now = datetime.now(ZoneInfo("Asia/Tokyo"))
-    now_time = f"{now.hour}時{now.minute:02d}分"
+# 取引所の立会時間と休場日（立会時間外の銘柄はYahooに問い合わせず終値のスナップショットを使う）
+# 半日立会は考慮しない。MARKET_HOLIDAYS_PATHのJSON（{"TSE": ["2028-01-03", ...]}）で休場日を追加できる
+EXCHANGES = {
+    "TSE": {
+        "tz": ZoneInfo("Asia/Tokyo"),
+        "sessions": [((9, 0), (11, 30)), ((12, 30), (15, 30))],
+        "holidays": {
+            "2025-01-01", "2025-01-02", "2025-01-03", "2025-01-13", "2025-02-11", "2025-02-24", "2025-03-20",
+            "2025-04-29", "2025-05-05", "2025-05-06", "2025-07-21", "2025-08-11", "2025-09-15", "2025-09-23",
+            "2025-10-13", "2025-11-03", "2025-11-24", "2025-12-31",
+            "2026-01-01", "2026-01-02", "2026-01-12", "2026-02-11", "2026-02-23", "2026-03-20", "2026-04-29",
+            "2026-05-04", "2026-05-05", "2026-05-06", "2026-07-20", "2026-08-11", "2026-09-21", "2026-09-22",
+            "2026-09-23", "2026-10-12", "2026-11-03", "2026-11-23", "2026-12-31",
+            "2027-01-01", "2027-01-11", "2027-02-11", "2027-02-23", "2027-03-22", "2027-04-29", "2027-05-03",
+            "2027-05-04", "2027-05-05", "2027-07-19", "2027-08-11", "2027-09-20", "2027-09-23", "2027-10-11",
+            "2027-11-03", "2027-11-23", "2027-12-31",
+        },
+    },
+    "US": {
+        "tz": ZoneInfo("America/New_York"),
+        "sessions": [((9, 30), (16, 0))],
+        "holidays": {
+            "2025-01-01", "2025-01-09", "2025-01-20", "2025-02-17", "2025-04-18", "2025-05-26", "2025-06-19",
+            "2025-07-04", "2025-09-01", "2025-11-27", "2025-12-25",
+            "2026-01-01", "2026-01-19", "2026-02-16", "2026-04-03", "2026-05-25", "2026-06-19", "2026-07-03",
+            "2026-09-07", "2026-11-26", "2026-12-25",
+            "2027-01-01", "2027-01-18", "2027-02-15", "2027-03-26", "2027-05-31", "2027-06-18", "2027-07-05",
+            "2027-09-06", "2027-11-25", "2027-12-24",
+        },
+    },
+}
+# 引けの後、Yahooの値が終値に確定するまで待つ時間（分）
+MARKET_CLOSE_GRACE_MINUTES = float(os.getenv("MARKET_CLOSE_GRACE_MINUTES", "15"))
 
-    notifications = supabase.table("notifications").select("*").execute().data
-    for n in notifications:
-        user_id = n["line_user_id"]
-        cond_type = n["condition_type"]
-        cond_detail = eval(n["condition_detail"])
-        ticker = n.get("ticker", "7203.T")
+def load_market_holidays():
+    path = os.getenv("MARKET_HOLIDAYS_PATH")
+    if not path:
+        return
+    with open(path, encoding="utf-8") as f:
+        for exchange, days in json.load(f).items():
+            if exchange in EXCHANGES:
+                EXCHANGES[exchange]["holidays"].update(days)
+
+load_market_holidays()
+
+# ティッカーから取引所を判定する（.Tは東証、サフィックスなしは米国株、それ以外は不明）
+def exchange_of(ticker: str):
+    if ticker.endswith(".T"):
+        return "TSE"
+    if "." not in ticker and "=" not in ticker and not ticker.startswith("^"):
+        return "US"
+    return None
+
+def _is_trading_day(exchange: dict, date):
+    return date.weekday() < 5 and date.isoformat() not in exchange["holidays"]
+
+# 立会時間外ならその直前の立会の終了時刻を、立会中（または取引所が不明）ならNoneを返す
+def market_closed_since(ticker: str, now: datetime = None):
+    name = exchange_of(ticker)
+    if name is None:
+        return None
+    exchange = EXCHANGES[name]
+    local_now = (now or datetime.now(timezone.utc)).astimezone(exchange["tz"])
+    for offset in range(0, 15):
+        date = (local_now - timedelta(days=offset)).date()
+        if not _is_trading_day(exchange, date):
+            continue
+        for (open_h, open_m), (close_h, close_m) in reversed(exchange["sessions"]):
+            opens = datetime(date.year, date.month, date.day, open_h, open_m, tzinfo=exchange["tz"])
+            closes = datetime(date.year, date.month, date.day, close_h, close_m, tzinfo=exchange["tz"])
+            if opens <= local_now < closes:
+                return None
+            if closes <= local_now:
+                return closes
+    return None
+
+def is_market_open(ticker: str, now: datetime = None):
+    return market_closed_since(ticker, now) is None
+
+# 最後に取得した株価（立会時間外はこれを使う）: ticker -> (取得時刻, 通知の表示に使う項目だけのinfo)
+# 週末・連休をまたいでも残るように長めのTTLにし、件数はQUOTE_SNAPSHOT_SIZEで抑える
+QUOTE_SNAPSHOT_FIELDS = ("currentPrice", "previousClose", "open", "dayHigh", "dayLow", "volume")
+QUOTE_SNAPSHOT_TTL = float(os.getenv("QUOTE_SNAPSHOT_TTL", str(5 * 24 * 3600)))
+QUOTE_SNAPSHOT_SIZE = int(os.getenv("QUOTE_SNAPSHOT_SIZE", "2000"))
+quote_snapshots = TTLCache(QUOTE_SNAPSHOT_TTL, QUOTE_SNAPSHOT_SIZE)
+
+# 銘柄ごとの立会状況（通知チェック1回の中では銘柄ごとに1回だけ判定する）
+def market_open_map(tickers, now: datetime = None):
+    return {ticker: is_market_open(ticker, now) for ticker in set(tickers)}
+
+# 株価キャッシュ（チャットでの検索と通知チェックで共有）
+QUOTE_CACHE_TTL = float(os.getenv("QUOTE_CACHE_TTL", "30"))
+QUOTE_CACHE_SIZE = int(os.getenv("QUOTE_CACHE_SIZE", "2000"))
+quote_cache = TTLCache(QUOTE_CACHE_TTL, QUOTE_CACHE_SIZE)
+quote_flight = SingleFlight()
+
+def _fetch_quote_uncached(ticker: str):
+    with timed("external_call_seconds", service="yahoo", op="info"):
+        info = get_yf().Ticker(ticker).info
+    price_history.record(ticker, info.get("currentPrice"))
+    quote_cache.set(ticker, info)
+    quote_snapshots.set(ticker, (time.time(), {k: info[k] for k in QUOTE_SNAPSHOT_FIELDS if k in info}))
+    return info
+
+def fetch_quote(ticker: str):
+    # 立会時間外は、引け後に取得したスナップショットがあればそれを返す
+    closed_since = market_closed_since(ticker)
+    if closed_since is not None:
+        snapshot = quote_snapshots.get(ticker)
+        if snapshot and snapshot[0] >= closed_since.timestamp() + MARKET_CLOSE_GRACE_MINUTES * 60:
+            return snapshot[1]
+    info = quote_cache.get(ticker)
+    if info is not None:
+        return info
+    return quote_flight.do(ticker, lambda: _fetch_quote_uncached(ticker))
+
+# 複数銘柄の株価をまとめて取得する（同じ銘柄は1回だけ取得）
+def fetch_quotes(tickers):
+    unique_tickers = list(dict.fromkeys(tickers))
+    quotes = {}
+    if not unique_tickers:
+        return quotes
+
+    def _fetch(ticker):
+        try:
+            return ticker, fetch_quote(ticker)
+        except Exception as e:
+            print(f"株価取得失敗 ({ticker}):", e)
+            return ticker, None
 
-        stock = yf.Ticker(ticker)
-        info = stock.info
-        current_price = info.get("currentPrice")
-        prev_close = info.get("previousClose")
+    with ThreadPoolExecutor(max_workers=min(QUOTE_FETCH_WORKERS, len(unique_tickers))) as pool:
+        for ticker, info in pool.map(_fetch, unique_tickers):
+            if info is not None:
+                quotes[ticker] = info
+    return quotes
 
+JST = ZoneInfo("Asia/Tokyo")
+WEEKDAYS = ["月", "火", "水", "木", "金", "土", "日"]
+TIME_CONDITION_TYPES = ("daily", "weekly", "monthly")
+PRICE_CONDITION_TYPES = ("price_over", "price_under", "percent_up", "percent_down")
+_THRESHOLD_FIELDS = {"price_over": "price", "price_under": "price", "percent_up": "percent", "percent_down": "percent"}
+WINDOW_CONDITION_TYPES = ("window_up", "window_down", "ma_cross_up", "ma_cross_down")
+# 取りこぼした時間通知をさかのぼって送る上限（これより古い予定は送らずに次回へ回す）
+SCHEDULE_CATCHUP_MINUTES = int(os.getenv("SCHEDULE_CATCHUP_MINUTES", "60"))
+
+# 「17時4分」「9時00分」を(時, 分)に変換する
+def parse_clock(text: str):
+    match = re.match(r"(\d{1,2})時(\d{1,2})?分?", text or "")
+    if not match:
+        return None
+    hour, minute = int(match[1]), int(match[2] or 0)
+    if hour > 23 or minute > 59:
+        return None
+    return hour, minute
+
+# 時間ベースの通知条件（daily / weekly / monthly）
+class TimeCondition:
+    def __init__(self, cond_type: str, clocks, weekday=None, day=None):
+        self.type = cond_type
+        self.clocks = sorted(clocks)
+        self.weekday = weekday
+        self.day = day
+
+    # afterより後で最初に通知する日時を計算する
+    def next_fire(self, after: datetime):
+        start = after.replace(hour=0, minute=0, second=0, microsecond=0)
+        for offset in range(0, 366 if self.type == "monthly" else 8):
+            date = start + timedelta(days=offset)
+            if self.weekday is not None and date.weekday() != self.weekday:
+                continue
+            if self.day is not None and date.day != self.day:
+                continue
+            for hour, minute in self.clocks:
+                fire_at = date.replace(hour=hour, minute=minute)
+                if fire_at > after:
+                    return fire_at
+        return None
+
+# 価格・変動率の通知条件（price_over / price_under / percent_up / percent_down）
+class ThresholdCondition:
+    def __init__(self, cond_type: str, threshold: float):
+        self.type = cond_type
+        self.threshold = threshold
+
+    def matches(self, current_price, prev_close):
+        if current_price is None:
+            return False
+        if self.type == "price_over":
+            return current_price >= self.threshold
+        if self.type == "price_under":
+            return current_price <= self.threshold
+        if not prev_close:
+            return False
+        diff_percent = ((current_price - prev_close) / prev_close) * 100
+        if self.type == "percent_up":
+            return diff_percent >= self.threshold
+        return diff_percent <= -self.threshold
+
+# 直近の値動きを使う通知条件（window_up / window_down / ma_cross_up / ma_cross_down）
+class WindowCondition:
+    def __init__(self, cond_type: str, minutes: int, percent: float = None):
+        self.type = cond_type
+        self.minutes = minutes
+        self.percent = percent
+
+# condition_detailを読み込む（JSON。以前のstr(dict)形式の行もevalせずに読む）
+def load_condition_detail(text: str):
+    try:
+        return json.loads(text)
+    except (TypeError, ValueError):
+        return ast.literal_eval(text)
+
+# 通知条件を判定用のオブジェクトに変換する（同じ条件文字列は1回だけ変換する）
+@functools.lru_cache(maxsize=4096)
+def compile_condition(cond_type: str, condition_detail: str):
+    try:
+        detail = load_condition_detail(condition_detail)
+    except (ValueError, SyntaxError):
+        print("通知条件を読み込めません:", condition_detail)
+        return None
+    if not isinstance(detail, dict):
+        print("通知条件の形式が不正です:", condition_detail)
+        return None
+
+    if cond_type in TIME_CONDITION_TYPES:
         if cond_type == "daily":
-            if now_time in cond_detail.get("times", []):
-                send_stock_info(user_id, ticker, info)
+            clocks = [parse_clock(t) for t in detail.get("times", [])]
+        else:
+            clocks = [parse_clock(detail.get("time"))]
+        clocks = [c for c in clocks if c]
+        if not clocks:
+            return None
+        if cond_type == "weekly":
+            day = (detail.get("day") or "")[:1]  # 「木曜」「木」どちらも受け付ける
+            if day not in WEEKDAYS:
+                return None
+            return TimeCondition(cond_type, clocks, weekday=WEEKDAYS.index(day))
+        if cond_type == "monthly":
+            return TimeCondition(cond_type, clocks, day=detail.get("day"))
+        return TimeCondition(cond_type, clocks)
+
+    if cond_type in WINDOW_CONDITION_TYPES:
+        minutes = detail.get("minutes")
+        if not minutes or (cond_type.startswith("window") and detail.get("percent") is None):
+            return None
+        return WindowCondition(cond_type, int(minutes), detail.get("percent"))
+
+    field = _THRESHOLD_FIELDS.get(cond_type)
+    if field and detail.get(field) is not None:
+        return ThresholdCondition(cond_type, detail[field])
+    return None
+
+def row_condition(n: dict):
+    return compile_condition(n["condition_type"], n["condition_detail"])
+
+def notification_key(n: dict):
+    return n.get("id") or (n["line_user_id"], n.get("ticker"), n["condition_detail"])
+
+# 時間ベースの通知を次回通知時刻の順にヒープで管理し、時刻が来たものだけを取り出す
+class NotificationScheduler:
+    def __init__(self, last_run: datetime = None):
+        self._rows = {}  # key -> [row, condition, 有効なヒープ要素のseq]
+        self._heap = []  # (fire_at, seq, key)
+        self._seq = 0
+        self._last_run = last_run
+
+    @property
+    def last_run(self):
+        return self._last_run
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _push(self, key, after):
+        entry = self._rows[key]
+        fire_at = entry[1].next_fire(after) if entry[1] is not None else None
+        self._seq += 1
+        entry[2] = self._seq  # 以前に積んだ要素は無効になる
+        if fire_at is not None:
+            heapq.heappush(self._heap, (fire_at, self._seq, key))
+
+    # テーブルの内容と同期する（追加・変更された行だけ予定を計算し、削除された行は取り出し時に捨てる）
+    def sync(self, rows, now: datetime):
+        if self._last_run is None:
+            # 初回は現在の分の予定も対象にする
+            self._last_run = now.replace(second=0, microsecond=0) - timedelta(seconds=1)
+        current = {notification_key(n): n for n in rows}
+        for key in list(self._rows):
+            if key not in current:
+                del self._rows[key]
+        for key, n in current.items():
+            entry = self._rows.get(key)
+            if entry is None or entry[0]["condition_detail"] != n["condition_detail"]:
+                self._rows[key] = [n, row_condition(n), 0]
+                self._push(key, self._last_run)
+            else:
+                entry[0] = n
+
+    # 前回の実行からnowまでに時刻が来た通知を返す（取りこぼした分も含め1行につき1回）
+    def pop_due(self, now: datetime):
+        due = []
+        oldest = now - timedelta(minutes=SCHEDULE_CATCHUP_MINUTES)
+        while self._heap and self._heap[0][0] <= now:
+            fire_at, seq, key = heapq.heappop(self._heap)
+            entry = self._rows.get(key)
+            if entry is None or entry[2] != seq:
+                continue
+            if fire_at >= oldest:
+                due.append(entry[0])
+            self._push(key, now)
+        self._last_run = now
+        return due
 
-        elif cond_type == "weekly":
-            weekday_map = ["月", "火", "水", "木", "金", "土", "日"]
-            today = weekday_map[now.weekday()]
-            if cond_detail["day"] == today and cond_detail["time"] == now_time:
-                send_stock_info(user_id, ticker, info)
+# 銘柄ごとのしきい値を種類別にソートして持ち、株価1件につき二分探索で条件を満たす行を求める
+# 一度通知した行は条件を満たさなくなるまで再通知しない（1回の上抜け・下抜けにつき1通知）
+class ThresholdIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rows = {}  # key -> (row, ticker, cond_type, threshold)
+        self._tables = {}  # ticker -> {cond_type: ([threshold...], [key...])}
+        self._by_user = {}  # line_user_id -> set(key)
+        self._fired = {}  # ticker -> set(key)
 
-        elif cond_type == "monthly":
-            if now.day == cond_detail["day"] and cond_detail["time"] == now_time:
-                send_stock_info(user_id, ticker, info)
+    def __len__(self):
+        return len(self._rows)
 
-        elif cond_type in ["percent_up", "percent_down"]:
-            if prev_close and current_price:
+    def tickers(self):
+        with self._lock:
+            return [ticker for ticker, tables in self._tables.items() if any(t[0] for t in tables.values())]
+
+    def add(self, row: dict):
+        cond_type = row.get("condition_type")
+        if cond_type not in PRICE_CONDITION_TYPES:
+            return
+        condition = row_condition(row)
+        if condition is None:
+            return
+        threshold = condition.threshold
+        key = notification_key(row)
+        ticker = row.get("ticker") or "7203.T"
+        with self._lock:
+            self._remove(key)
+            thresholds, keys = self._tables.setdefault(ticker, {}).setdefault(cond_type, ([], []))
+            i = bisect.bisect_right(thresholds, threshold)
+            thresholds.insert(i, threshold)
+            keys.insert(i, key)
+            self._rows[key] = (row, ticker, cond_type, threshold)
+            self._by_user.setdefault(row["line_user_id"], set()).add(key)
+
+    def remove(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self._rows.pop(key, None)
+        if entry is None:
+            return
+        row, ticker, cond_type, threshold = entry
+        thresholds, keys = self._tables[ticker][cond_type]
+        i = bisect.bisect_left(thresholds, threshold)
+        while keys[i] != key:
+            i += 1
+        del thresholds[i]
+        del keys[i]
+        self._by_user.get(row["line_user_id"], set()).discard(key)
+        self._fired.get(ticker, set()).discard(key)
+
+    # 「通知取消」「初期化」で消した行を取り除く（tickerを省略するとそのユーザーの全行）
+    def remove_user(self, line_user_id: str, ticker: str = None):
+        with self._lock:
+            for key in list(self._by_user.get(line_user_id, ())):
+                if ticker is None or self._rows[key][1] == ticker:
+                    self._remove(key)
+
+    # テーブルの内容と同期する（追加・変更された行だけを入れ直す）
+    def sync(self, rows):
+        current = {notification_key(n): n for n in rows}
+        with self._lock:
+            stale = [key for key, entry in self._rows.items()
+                     if key not in current or entry[0]["condition_detail"] != current[key]["condition_detail"]]
+            for key in stale:
+                self._remove(key)
+            new_rows = [n for key, n in current.items() if key not in self._rows]
+        for n in new_rows:
+            self.add(n)
+
+    # 新しい株価で条件を満たした行のうち、前回は満たしていなかったものを返す
+    # acceptを渡すと、その条件に合う行だけを判定・状態更新の対象にする（シャードごとの判定用）
+    def evaluate(self, ticker: str, current_price, prev_close, accept=None):
+        with self._lock:
+            tables = self._tables.get(ticker)
+            if not tables or current_price is None:
+                return []
+            triggered = {}
+
+            def _take(cond_type, lo, hi, diff_percent=None):
+                for key in tables[cond_type][1][lo:hi]:
+                    triggered[key] = diff_percent
+
+            if "price_over" in tables:
+                _take("price_over", None, bisect.bisect_right(tables["price_over"][0], current_price))
+            if "price_under" in tables:
+                _take("price_under", bisect.bisect_left(tables["price_under"][0], current_price), None)
+            if prev_close:
                 diff_percent = ((current_price - prev_close) / prev_close) * 100
-                if cond_type == "percent_up" and diff_percent >= cond_detail["percent"]:
-                    send_stock_info(user_id, ticker, info, diff_percent)
-                elif cond_type == "percent_down" and diff_percent <= -cond_detail["percent"]:
-                    send_stock_info(user_id, ticker, info, diff_percent)
+                if "percent_up" in tables:
+                    _take("percent_up", None, bisect.bisect_right(tables["percent_up"][0], diff_percent), diff_percent)
+                if "percent_down" in tables:
+                    _take("percent_down", None, bisect.bisect_right(tables["percent_down"][0], -diff_percent), diff_percent)
+
+            # 前日終値がない株価では変動率の行を判定できないので、その行の通知済み状態はそのまま残す
+            evaluated = {"price_over", "price_under"} | ({"percent_up", "percent_down"} if prev_close else set())
+            fired = self._fired.get(ticker, set())
+            if accept is not None:
+                triggered = {key: d for key, d in triggered.items() if accept(self._rows[key][0])}
+            self._fired[ticker] = {
+                key for key in fired
+                if self._rows[key][2] not in evaluated or (accept is not None and not accept(self._rows[key][0]))
+            } | set(triggered)
+            return [(self._rows[key][0], triggered[key]) for key in triggered if key not in fired]
+
+    # シャードを引き継ぐワーカーに渡すため、rowsのうち通知済みの行のキーを返す
+    def fired_keys(self, rows):
+        with self._lock:
+            fired = set().union(*self._fired.values())
+        return [notification_key(n) for n in rows if notification_key(n) in fired]
+
+    # 前のワーカーが通知済みにした行を引き継ぐ（rowsのうちfiredにない行は未通知に戻す）
+    def restore_fired(self, rows, fired):
+        with self._lock:
+            for n in rows:
+                key = notification_key(n)
+                entry = self._rows.get(key)
+                if entry is None:
+                    continue
+                if key in fired:
+                    self._fired.setdefault(entry[1], set()).add(key)
+                else:
+                    self._fired.get(entry[1], set()).discard(key)
+
+threshold_index = ThresholdIndex()
+
+NOTIFICATION_PAGE_SIZE = int(os.getenv("NOTIFICATION_PAGE_SIZE", "1000"))
+# 取りこぼした行や直接削除された行を反映するためにid一覧を照合する間隔（秒）
+NOTIFICATION_RECONCILE_SECONDS = float(os.getenv("NOTIFICATION_RECONCILE_SECONDS", "600"))
+# 論理削除した行（deleted_atあり）を物理削除するまでの時間（秒）。全ワーカーがこの間に同期する前提
+NOTIFICATION_TOMBSTONE_SECONDS = float(os.getenv("NOTIFICATION_TOMBSTONE_SECONDS", "86400"))
+
+# notificationsテーブルの手元のコピー
+# 毎回全件を取得せず、前回以降に(updated_at, id)が進んだ行だけを取得する
+# 削除はdeleted_atとupdated_atを更新する論理削除なので、他のワーカーの削除も次の同期で反映される
+class NotificationMirror:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rows = {}  # key -> row
+        self._watermark = None  # 最後に取得した行の(updated_at, id)
+        self._last_reconcile = 0.0
+
+    def __len__(self):
+        return len(self._rows)
+
+    # 削除されていない全行をidの順にページングして取得する
+    def _fetch_live(self, columns="*", ids=None):
+        rows = []
+        last_id = None
+        while True:
+            query = supabase.table("notifications").select(columns).is_("deleted_at", "null")
+            if ids is not None:
+                query = query.in_("id", ids)
+            if last_id is not None:
+                query = query.gt("id", last_id)
+            page = query.order("id").limit(NOTIFICATION_PAGE_SIZE).execute().data
+            rows.extend(page)
+            if len(page) < NOTIFICATION_PAGE_SIZE:
+                return rows
+            last_id = page[-1]["id"]
+
+    # ウォーターマークより後に更新された行（論理削除された行を含む）を(updated_at, id)の順に取得する
+    def _fetch_changes(self):
+        rows = []
+        while True:
+            updated_at, last_id = self._watermark
+            page = (
+                supabase.table("notifications").select("*")
+                .or_(f'updated_at.gt."{updated_at}",and(updated_at.eq."{updated_at}",id.gt.{last_id})')
+                .order("updated_at").order("id").limit(NOTIFICATION_PAGE_SIZE).execute().data
+            )
+            rows.extend(page)
+            if page:
+                self._watermark = (page[-1]["updated_at"], page[-1]["id"])
+            if len(page) < NOTIFICATION_PAGE_SIZE:
+                return rows
+
+    def _apply(self, rows):
+        for n in rows:
+            if n.get("deleted_at"):
+                self._rows.pop(notification_key(n), None)
+            else:
+                self._rows[notification_key(n)] = n
+
+    def refresh(self):
+        with self._lock:
+            if self._watermark is None:
+                rows = self._fetch_live()
+                self._rows = {}
+                self._apply(rows)
+                stamped = [n for n in rows if n.get("updated_at")]
+                if stamped:
+                    latest = max(stamped, key=lambda n: (n["updated_at"], n["id"]))
+                    self._watermark = (latest["updated_at"], latest["id"])
+                self._last_reconcile = time.monotonic()
+            else:
+                self._apply(self._fetch_changes())
+                if time.monotonic() - self._last_reconcile >= NOTIFICATION_RECONCILE_SECONDS:
+                    self._reconcile()
+            return list(self._rows.values())
+
+    # id一覧と照合し、直接削除された行を取り除き、取りこぼした行を読み込む。古い論理削除の行もここで消す
+    def _reconcile(self):
+        ids = {n["id"] for n in self._fetch_live("id")}
+        for key in [k for k, n in self._rows.items() if n.get("id") not in ids]:
+            del self._rows[key]
+        known = {n.get("id") for n in self._rows.values()}
+        missing = sorted(ids - known)
+        for start in range(0, len(missing), NOTIFICATION_PAGE_SIZE):
+            self._apply(self._fetch_live(ids=missing[start:start + NOTIFICATION_PAGE_SIZE]))
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=NOTIFICATION_TOMBSTONE_SECONDS)
+        supabase.table("notifications").delete().lt("deleted_at", cutoff.isoformat()).execute()
+        self._last_reconcile = time.monotonic()
+
+    def add(self, row: dict):
+        with self._lock:
+            self._rows[notification_key(row)] = row
+
+    def remove_user(self, line_user_id: str, ticker: str = None):
+        with self._lock:
+            for key, n in list(self._rows.items()):
+                if n["line_user_id"] == line_user_id and (ticker is None or n.get("ticker") == ticker):
+                    del self._rows[key]
+
+notification_mirror = NotificationMirror()
+
+# 通知設定を論理削除する（tickerを省略するとそのユーザーの全行）
+def delete_notifications(line_user_id: str, ticker: str = None):
+    now = datetime.now(timezone.utc).isoformat()
+    query = supabase.table("notifications").update({"deleted_at": now, "updated_at": now})
+    query = query.eq("line_user_id", line_user_id).is_("deleted_at", "null")
+    if ticker is not None:
+        query = query.eq("ticker", ticker)
+    query.execute()
+    notification_mirror.remove_user(line_user_id, ticker)
+
+# 銘柄ごとの直近の株価履歴（NumPy配列のリングバッファ）
+# PRICE_HISTORY_PATHを指定するとディレクトリ内のmemmapファイルに保存し、再起動後も引き継ぐ
+PRICE_HISTORY_CAPACITY = int(os.getenv("PRICE_HISTORY_CAPACITY", "480"))
+PRICE_HISTORY_MAX_TICKERS = int(os.getenv("PRICE_HISTORY_MAX_TICKERS", "1024"))
+# 同じ銘柄を記録する最短間隔（秒）。ストリーミングの細かいティックでバッファがすぐに埋まらないようにする
+PRICE_HISTORY_MIN_INTERVAL = float(os.getenv("PRICE_HISTORY_MIN_INTERVAL", "30"))
+
+class PriceHistory:
+    def __init__(self, capacity: int, max_tickers: int, path: str = None):
+        self.capacity = capacity
+        self.max_tickers = max_tickers
+        self.path = path
+        self._lock = threading.Lock()
+        self._np = None
+        self._rows = {}  # ticker -> 行番号
+        self._watched = set()  # 期間内の変動・移動平均の通知がある銘柄（これ以外は記録しない）
+
+    # 記録する銘柄を通知設定に合わせて入れ替える
+    def watch(self, tickers):
+        with self._lock:
+            self._watched = set(tickers)
+
+    def _init(self):
+        if self._np is not None:
+            return self._np
+        import numpy as np
+
+        shape = (self.max_tickers, self.capacity)
+        if self.path:
+            os.makedirs(self.path, exist_ok=True)
+            meta_path = os.path.join(self.path, "meta.json")
+            meta = {}
+            if os.path.exists(meta_path):
+                with open(meta_path, encoding="utf-8") as f:
+                    meta = json.load(f)
+            reuse = meta.get("shape") == list(shape)
+            mode = "r+" if reuse else "w+"
+            self._prices = np.lib.format.open_memmap(os.path.join(self.path, "prices.npy"), mode=mode, dtype=np.float64, shape=shape)
+            self._times = np.lib.format.open_memmap(os.path.join(self.path, "times.npy"), mode=mode, dtype=np.float64, shape=shape)
+            self._heads = np.lib.format.open_memmap(os.path.join(self.path, "heads.npy"), mode=mode, dtype=np.int64, shape=(self.max_tickers,))
+            if reuse:
+                self._rows = {ticker: i for i, ticker in enumerate(meta.get("tickers", []))}
+            else:
+                self._prices[:] = np.nan
+                self._times[:] = np.nan
+                self._heads[:] = 0
+        else:
+            self._prices = np.full(shape, np.nan)
+            self._times = np.full(shape, np.nan)
+            self._heads = np.zeros(self.max_tickers, dtype=np.int64)
+        self._np = np
+        return np
+
+    def record(self, ticker: str, price, at: float = None):
+        if price is None:
+            return
+        at = at or time.time()
+        with self._lock:
+            if ticker not in self._watched:
+                return
+            self._init()
+            row = self._rows.get(ticker)
+            if row is None:
+                row = self._allocate(ticker)
+                if row is None:
+                    return
+            head = int(self._heads[row])
+            if head and at - self._times[row, (head - 1) % self.capacity] < PRICE_HISTORY_MIN_INTERVAL:
+                # 間隔が短いときは最新の値だけを書き換える
+                self._prices[row, (head - 1) % self.capacity] = price
+                return
+            self._prices[row, head % self.capacity] = price
+            self._times[row, head % self.capacity] = at
+            self._heads[row] = head + 1
+
+    # 新しい銘柄に行を割り当てる。満杯なら通知のなくなった銘柄、なければ最も長く更新のない銘柄の行を使い回す
+    def _allocate(self, ticker: str):
+        if len(self._rows) < self.max_tickers:
+            row = self._rows[ticker] = len(self._rows)
+            return row
+        if not self.max_tickers:
+            return None
+
+        def _last_at(item):
+            row = item[1]
+            head = int(self._heads[row])
+            return self._times[row, (head - 1) % self.capacity] if head else -1.0
+
+        unwatched = [item for item in self._rows.items() if item[0] not in self._watched]
+        victim, row = min(unwatched or self._rows.items(), key=_last_at)
+        if not unwatched:
+            print(f"株価履歴が上限（{self.max_tickers}銘柄）に達したため、{victim}の履歴を破棄して{ticker}を記録します")
+        del self._rows[victim]
+        self._prices[row] = self._np.nan
+        self._times[row] = self._np.nan
+        self._heads[row] = 0
+        self._rows[ticker] = row
+        return row
+
+    def flush(self):
+        if not self.path or self._np is None:
+            return
+        with self._lock:
+            self._prices.flush()
+            self._times.flush()
+            self._heads.flush()
+            tickers = sorted(self._rows, key=self._rows.get)
+            with open(os.path.join(self.path, "meta.json"), "w", encoding="utf-8") as f:
+                json.dump({"shape": [self.max_tickers, self.capacity], "tickers": tickers}, f)
+
+    # 全銘柄について、直近minutes分の変動率（最古の値→最新の値）と移動平均を一度に計算する
+    # 戻り値: {ticker: (最新値, 変動率%, 移動平均)}
+    def window_stats(self, minutes: int, now: float = None):
+        now = now or time.time()
+        with self._lock:
+            if self._np is None or not self._rows:
+                return {}
+            np = self._np
+            n = len(self._rows)
+            prices = np.array(self._prices[:n])
+            times = np.array(self._times[:n])
+            heads = np.array(self._heads[:n])
+            tickers = dict(self._rows)
+        rows = np.arange(n)
+        in_window = times >= now - minutes * 60
+        latest = prices[rows, (heads - 1) % self.capacity]
+        oldest_index = np.argmin(np.where(in_window, times, np.inf), axis=1)
+        oldest = prices[rows, oldest_index]
+        count = in_window.sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            change = (latest - oldest) / oldest * 100
+            average = np.where(in_window, prices, 0).sum(axis=1) / count
+        stats = {}
+        for ticker, row in tickers.items():
+            if row < n and count[row] >= 2 and heads[row] > 0:
+                stats[ticker] = (float(latest[row]), float(change[row]), float(average[row]))
+        return stats
+
+price_history = PriceHistory(PRICE_HISTORY_CAPACITY, PRICE_HISTORY_MAX_TICKERS, os.getenv("PRICE_HISTORY_PATH") or None)
+
+# 期間内の変動・移動平均との交差の判定（条件を満たし始めたときだけ通知する）
+class WindowAlertEvaluator:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fired = set()
+        self._seen = set()
+        self._owners = {}  # key -> (line_user_id, ticker)。削除された行の状態を消すために使う
+
+    # 現在の行にないキーの状態を捨てる（他のワーカーでの削除も含めて反映する）
+    def sync(self, rows):
+        current = {notification_key(n) for n in rows}
+        with self._lock:
+            for key in [k for k in self._owners if k not in current]:
+                self._forget(key)
+
+    # 「通知取消」「初期化」で消した行を取り除く（tickerを省略するとそのユーザーの全行）
+    def remove_user(self, line_user_id: str, ticker: str = None):
+        with self._lock:
+            for key, (user_id, row_ticker) in list(self._owners.items()):
+                if user_id == line_user_id and (ticker is None or row_ticker == ticker):
+                    self._forget(key)
+
+    def _forget(self, key):
+        self._owners.pop(key, None)
+        self._fired.discard(key)
+        self._seen.discard(key)
+
+    # rowsのうち新たに条件を満たした行を返す。statsは{分: price_history.window_statsの結果}
+    def evaluate(self, rows, stats):
+        triggered = []
+        with self._lock:
+            for n in rows:
+                condition = row_condition(n)
+                values = stats.get(condition.minutes, {}).get(n.get("ticker") or "7203.T") if condition else None
+                if values is None:
+                    continue
+                latest, change, average = values
+                if condition.type == "window_up":
+                    hit = change >= condition.percent
+                elif condition.type == "window_down":
+                    hit = change <= -condition.percent
+                elif condition.type == "ma_cross_up":
+                    hit = latest > average
+                else:
+                    hit = latest < average
+                key = notification_key(n)
+                self._owners[key] = (n["line_user_id"], n.get("ticker"))
+                if key not in self._seen and condition.type.startswith("ma_cross"):
+                    # 移動平均との交差は、最初に見たときの位置を記録するだけにする
+                    self._seen.add(key)
+                    if hit:
+                        self._fired.add(key)
+                    continue
+                self._seen.add(key)
+                if not hit:
+                    self._fired.discard(key)
+                elif key not in self._fired:
+                    self._fired.add(key)
+                    triggered.append((n, change, condition, average))
+        return triggered
+
+    # シャードを引き継ぐワーカーに渡すため、rowsのうち(通知済み, 判定済み)の行のキーを返す
+    def state_keys(self, rows):
+        keys = [notification_key(n) for n in rows]
+        with self._lock:
+            return [k for k in keys if k in self._fired], [k for k in keys if k in self._seen]
+
+    def restore_state(self, rows, fired, seen):
+        with self._lock:
+            for n in rows:
+                key = notification_key(n)
+                self._owners[key] = (n["line_user_id"], n.get("ticker"))
+                for keys, target in ((fired, self._fired), (seen, self._seen)):
+                    if key in keys:
+                        target.add(key)
+                    else:
+                        target.discard(key)
+
+window_evaluator = WindowAlertEvaluator()
+
+# 通知チェックを分割する単位（line_user_idのハッシュで振り分ける）
+CHECK_SHARDS = int(os.getenv("CHECK_SHARDS", "16"))
+CHECK_LEASE_SECONDS = float(os.getenv("CHECK_LEASE_SECONDS", "120"))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+# ストリーミングで通知を送るワーカーを1つに決めるためのリース（シャード番号の代わりに使う）
+STREAM_LEASE_SHARD = -1
+
+def shard_of(n: dict):
+    return zlib.crc32(n["line_user_id"].encode("utf-8")) % CHECK_SHARDS
+
+def _parse_last_run(value):
+    if not value:
+        return None
+    return datetime.fromisoformat(value).astimezone(JST)
+
+# 価格・変動率・期間内変動の通知済み状態（シャードを引き継いだワーカーが同じ通知を再送しないようにする）
+# notification_keyはidがない行ではタプルなので、JSONの文字列にして保存する
+def _alert_state_token(key):
+    return json.dumps(key, ensure_ascii=False, default=str)
+
+def export_alert_state(rows):
+    fired, seen = window_evaluator.state_keys([n for n in rows if n["condition_type"] in WINDOW_CONDITION_TYPES])
+    if streaming_engine is None:
+        fired += threshold_index.fired_keys([n for n in rows if n["condition_type"] in PRICE_CONDITION_TYPES])
+    return {"fired": [_alert_state_token(k) for k in fired], "seen": [_alert_state_token(k) for k in seen]}
+
+def restore_alert_state(rows, state):
+    state = state or {}
+    fired_tokens, seen_tokens = set(state.get("fired") or ()), set(state.get("seen") or ())
+    keys = {_alert_state_token(notification_key(n)): notification_key(n) for n in rows}
+    fired = {key for token, key in keys.items() if token in fired_tokens}
+    seen = {key for token, key in keys.items() if token in seen_tokens}
+    if streaming_engine is None:
+        threshold_index.restore_fired([n for n in rows if n["condition_type"] in PRICE_CONDITION_TYPES], fired)
+    window_evaluator.restore_state([n for n in rows if n["condition_type"] in WINDOW_CONDITION_TYPES], fired, seen)
+
+def _parse_alert_state(value):
+    if not value:
+        return None
+    return json.loads(value) if isinstance(value, str) else value
+
+# シャードのリース（同じシャードを同時に2つのワーカーが処理しないようにする）
+# claimはリースを取れたら(True, 前回の実行時刻, 通知済み状態)を返す。期限切れのリースは他のワーカーが取り直せる
+class MemoryLeaseStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._leases = {}  # shard -> [owner, lease_until, last_run, alert_state]
 
-        elif cond_type == "price_over":
-            if current_price >= cond_detail["price"]:
-                send_stock_info(user_id, ticker, info)
+    def claim(self, shard: int):
+        with self._lock:
+            lease = self._leases.setdefault(shard, [None, 0.0, None, None])
+            if lease[1] > time.time() and lease[0] != WORKER_ID:
+                return False, None, None
+            lease[0], lease[1] = WORKER_ID, time.time() + CHECK_LEASE_SECONDS
+            return True, lease[2], lease[3]
 
-        elif cond_type == "price_under":
-            if current_price <= cond_detail["price"]:
-                send_stock_info(user_id, ticker, info)
+    def release(self, shard: int, last_run: datetime, alert_state: dict = None):
+        with self._lock:
+            lease = self._leases[shard]
+            if lease[0] == WORKER_ID:
+                lease[1], lease[2], lease[3] = 0.0, last_run, alert_state
 
-def send_stock_info(user_id, ticker, info, diff_percent=None):
+# 同じマシンの複数ワーカーで共有するリース（SQLite）
+class SQLiteLeaseStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS check_leases ("
+            "shard INTEGER PRIMARY KEY, owner TEXT, lease_until REAL NOT NULL, last_run TEXT, alert_state TEXT)"
+        )
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(check_leases)")}
+        if "alert_state" not in columns:
+            conn.execute("ALTER TABLE check_leases ADD COLUMN alert_state TEXT")
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            self._local.conn = conn
+        return conn
+
+    def claim(self, shard: int):
+        conn = self._conn()
+        now = time.time()
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO check_leases (shard, lease_until) VALUES (?, 0)", (shard,))
+            claimed = conn.execute(
+                "UPDATE check_leases SET owner = ?, lease_until = ? "
+                "WHERE shard = ? AND (lease_until < ? OR owner = ?)",
+                (WORKER_ID, now + CHECK_LEASE_SECONDS, shard, now, WORKER_ID),
+            ).rowcount
+        if not claimed:
+            return False, None, None
+        row = conn.execute("SELECT last_run, alert_state FROM check_leases WHERE shard = ?", (shard,)).fetchone()
+        return True, _parse_last_run(row[0]), _parse_alert_state(row[1])
+
+    def release(self, shard: int, last_run: datetime, alert_state: dict = None):
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "UPDATE check_leases SET lease_until = 0, last_run = ?, alert_state = ? WHERE shard = ? AND owner = ?",
+                (last_run.isoformat(), json.dumps(alert_state, ensure_ascii=False), shard, WORKER_ID),
+            )
+
+# 複数ノードで共有するリース（Supabaseのcheck_leasesテーブル。通知済み状態はjsonbのalert_state列に保存する）
+class SupabaseLeaseStore:
+    def __init__(self):
+        self._seeded = False
+
+    def _seed(self):
+        if self._seeded:
+            return
+        supabase.table("check_leases").upsert(
+            [{"shard": shard, "lease_until": datetime.fromtimestamp(0, timezone.utc).isoformat()}
+             for shard in [*range(CHECK_SHARDS), STREAM_LEASE_SHARD]],
+            on_conflict="shard", ignore_duplicates=True,
+        ).execute()
+        self._seeded = True
+
+    def claim(self, shard: int):
+        self._seed()
+        now = datetime.now(timezone.utc)
+        rows = supabase.table("check_leases").update({
+            "owner": WORKER_ID,
+            "lease_until": (now + timedelta(seconds=CHECK_LEASE_SECONDS)).isoformat(),
+        }).eq("shard", shard).or_(f"lease_until.lt.{now.isoformat()},owner.eq.{WORKER_ID}").execute().data
+        if not rows:
+            return False, None, None
+        return True, _parse_last_run(rows[0].get("last_run")), _parse_alert_state(rows[0].get("alert_state"))
+
+    def release(self, shard: int, last_run: datetime, alert_state: dict = None):
+        supabase.table("check_leases").update({
+            "lease_until": datetime.now(timezone.utc).isoformat(),
+            "last_run": last_run.isoformat(),
+            "alert_state": alert_state,
+        }).eq("shard", shard).eq("owner", WORKER_ID).execute()
+
+# CHECK_LEASE_STORE=memory（既定） / sqlite:<ファイルのパス> / supabase
+def create_lease_store():
+    backend = os.getenv("CHECK_LEASE_STORE", "memory")
+    if backend.startswith("sqlite:"):
+        return SQLiteLeaseStore(backend[len("sqlite:"):])
+    if backend == "supabase":
+        return SupabaseLeaseStore()
+    return MemoryLeaseStore()
+
+lease_store = create_lease_store()
+# シャードごとの時間通知スケジューラ
+shard_schedulers = {}
+
+# 直近の通知チェックの進み具合
+check_progress = {}
+check_lock = threading.Lock()
+
+# 処理中のシャードのリースを延長する。期限が切れて他のワーカーに取られていたらFalse
+def renew_shard_lease(shard: int):
+    claimed, _, _ = lease_store.claim(shard)
+    if not claimed:
+        print(f"シャード{shard}のリースを失ったため処理を中断します")
+        metrics.inc("check_lease_lost_total")
+    return claimed
+
+# 1シャード分の通知を判定し、送る通知の一覧を返す（途中でリースを失ったらNone）
+def check_shard(shard: int, rows, now: datetime, last_run: datetime, window_stats: dict = None, market_open: dict = None):
+    # 別のワーカーが前回このシャードを処理していた場合は、その実行時刻から予定を組み直す
+    scheduler = shard_schedulers.get(shard)
+    if scheduler is None or (last_run is not None and scheduler.last_run != last_run):
+        scheduler = shard_schedulers[shard] = NotificationScheduler(last_run)
+
+    # 時間ベースの通知はスケジューラで期限が来た行だけを取り出す
+    with timed("check_stage_seconds", stage="schedule"):
+        scheduler.sync([n for n in rows if n["condition_type"] in TIME_CONDITION_TYPES], now)
+        due_rows = scheduler.pop_due(now)
+    # 価格ベースの通知は立会中の銘柄だけを判定する（時間ベースの通知は立会時間外でもスナップショットで送る）
+    # ストリーミング中は価格・変動率の通知をストリーム側（リースを持つワーカー）だけが判定する
+    if market_open is None:
+        market_open = market_open_map(n.get("ticker") or "7203.T" for n in rows)
+    open_rows = [n for n in rows if market_open[n.get("ticker") or "7203.T"]]
+    threshold_tickers = set()
+    if streaming_engine is None:
+        threshold_tickers = {n.get("ticker") or "7203.T" for n in open_rows if n["condition_type"] in PRICE_CONDITION_TYPES}
+    price_tickers = set(threshold_tickers)
+    price_tickers |= {n.get("ticker") or "7203.T" for n in open_rows if n["condition_type"] in WINDOW_CONDITION_TYPES}
+
+    # 銘柄ごとに1回だけ株価を取得し、全行はこの取得結果で判定する
+    if not renew_shard_lease(shard):
+        return None
+    with timed("check_stage_seconds", stage="fetch_quotes"):
+        quotes = fetch_quotes([n.get("ticker") or "7203.T" for n in due_rows] + sorted(price_tickers))
+
+    with timed("check_stage_seconds", stage="evaluate"):
+        alerts = []
+        for n in due_rows:
+            ticker = n.get("ticker") or "7203.T"
+            info = quotes.get(ticker)
+            if info is not None:
+                alerts.append((n["line_user_id"], format_stock_info(ticker, info)))
+
+        # 価格・変動率の通知は銘柄ごとのしきい値インデックスで新たに条件を満たした行だけを通知する
+        in_shard = lambda n: shard_of(n) == shard
+        for ticker in threshold_tickers:
+            info = quotes.get(ticker)
+            if info is None:
+                continue
+            for n, diff_percent in threshold_index.evaluate(
+                ticker, info.get("currentPrice"), info.get("previousClose"), accept=in_shard
+            ):
+                alerts.append((n["line_user_id"], format_stock_info(ticker, info, diff_percent)))
+        # 期間内の変動・移動平均の通知は全銘柄分をまとめて計算した値で判定する
+        window_rows = [n for n in open_rows if n["condition_type"] in WINDOW_CONDITION_TYPES]
+        for n, change, condition, average in window_evaluator.evaluate(window_rows, window_stats or {}):
+            ticker = n.get("ticker") or "7203.T"
+            info = quotes.get(ticker) or quote_cache.get(ticker) or {}
+            if condition.type.startswith("ma_cross"):
+                headline = f"株価が{condition.minutes}分移動平均（{average:.1f}円）を{'上抜け' if condition.type == 'ma_cross_up' else '下抜け'}しました"
+            else:
+                headline = f"株価が{condition.minutes}分で{'上昇' if change > 0 else '下降'}しました（{change:.2f}%）"
+            alerts.append((n["line_user_id"], format_stock_info(ticker, info, headline=headline)))
+    metrics.inc("notifications_triggered_total", len(alerts))
+    return alerts
+
+# 全シャードを順にリースして処理する（他のワーカーが処理中のシャードは飛ばす）
+def check_and_send_notifications(progress: dict = None):
+    progress = progress if progress is not None else {}
+    now = datetime.now(JST)
+
+    with timed("check_stage_seconds", stage="sync"):
+        notifications = notification_mirror.refresh()
+        threshold_index.sync([n for n in notifications if n["condition_type"] in PRICE_CONDITION_TYPES])
+        window_evaluator.sync([n for n in notifications if n["condition_type"] in WINDOW_CONDITION_TYPES])
+    price_history.watch(n.get("ticker") or "7203.T" for n in notifications if n["condition_type"] in WINDOW_CONDITION_TYPES)
+    market_open = market_open_map(n.get("ticker") or "7203.T" for n in notifications)
+    rows_by_shard = {}
+    for n in notifications:
+        rows_by_shard.setdefault(shard_of(n), []).append(n)
+
+    # 期間内の変動・移動平均の通知がある銘柄の株価を先に記録し、期間ごとに全銘柄分を一度に計算する
+    window_rows = [
+        n for n in notifications
+        if n["condition_type"] in WINDOW_CONDITION_TYPES and market_open[n.get("ticker") or "7203.T"]
+    ]
+    window_stats = {}
+    if window_rows:
+        with timed("check_stage_seconds", stage="window_stats"):
+            fetch_quotes(n.get("ticker") or "7203.T" for n in window_rows)
+            for minutes in {c.minutes for c in map(row_condition, window_rows) if c}:
+                window_stats[minutes] = price_history.window_stats(minutes)
+
+    progress.update({"shards_total": CHECK_SHARDS, "shards_done": 0, "shards_skipped": 0, "shards": {}})
+    held = {}  # 今回リースを取ったシャード -> 送る通知の一覧（失敗・リース喪失ならNone）
+    try:
+        for shard in range(CHECK_SHARDS):
+            claimed, last_run, alert_state = lease_store.claim(shard)
+            if not claimed:
+                progress["shards_skipped"] += 1
+                progress["shards"][shard] = {"status": "leased_by_other"}
+                continue
+            held[shard] = None
+            started = time.monotonic()
+            rows = rows_by_shard.get(shard, [])
+            # 前回このシャードを処理したのが別のワーカーなら、そのワーカーの通知済み状態を引き継ぐ
+            scheduler = shard_schedulers.get(shard)
+            if last_run is not None and (scheduler is None or scheduler.last_run != last_run):
+                restore_alert_state(rows, alert_state)
+            try:
+                with timed("check_shard_seconds"):
+                    held[shard] = check_shard(shard, rows, now, last_run, window_stats, market_open)
+                progress["shards"][shard] = {
+                    "status": "lease_lost" if held[shard] is None else "evaluated", "rows": len(rows),
+                    "alerts": len(held[shard] or ()), "seconds": round(time.monotonic() - started, 3),
+                }
+            except Exception as e:
+                print(f"シャード{shard}の通知チェックに失敗しました:", e)
+                progress["shards"][shard] = {"status": "error", "rows": len(rows), "error": str(e)}
+            progress["shards_done"] += 1
+
+        # 全シャードの通知をまとめて送る（シャードをまたいで同じ内容のユーザーもmulticastで1回にまとめる）
+        # 判定中にリースを失ったシャードの通知は、取り直したワーカーが送るのでここでは送らない
+        with timed("check_stage_seconds", stage="deliver"):
+            alerts = []
+            for shard, shard_alerts in held.items():
+                if shard_alerts is None:
+                    continue
+                if renew_shard_lease(shard):
+                    alerts.extend(shard_alerts)
+                    progress["shards"][shard]["status"] = "done"
+                else:
+                    progress["shards"][shard]["status"] = "lease_lost"
+            progress["delivery"] = deliver_notifications(alerts)
+    finally:
+        for shard in held:
+            lease_store.release(
+                shard, shard_schedulers[shard].last_run if shard in shard_schedulers else now,
+                export_alert_state(rows_by_shard.get(shard, [])),
+            )
+    price_history.flush()
+    return progress
+
+def _run_check_in_background(progress: dict):
+    try:
+        check_and_send_notifications(progress)
+    except Exception as e:
+        print("通知チェックに失敗しました:", e)
+        progress["error"] = str(e)
+    finally:
+        progress["finished_at"] = time.time()
+        check_lock.release()
+
+def format_stock_info(ticker, info, diff_percent=None, headline=None):
     detail_url = f"https://finance.yahoo.co.jp/quote/{ticker}"
     price_info = (
         f"【{ticker}】\n"
@@ -489,7 +2442,361 @@ def send_stock_info(user_id, ticker, info, diff_percent=None):
         f"詳細: {detail_url}"
     )
 
-    if diff_percent is not None:
+    if headline is not None:
+        price_info = f"{headline}\n\n" + price_info
+    elif diff_percent is not None:
         price_info = f"株価が{'上昇' if diff_percent > 0 else '下降'}しました（{diff_percent:.2f}%）\n\n" + price_info
 
-    line_bot_api.push_message(user_id, TextSendMessage(text=price_info))
\ No newline at end of file
+    return price_info
+
+# LINEのAPI制限（1回の送信は最大5メッセージ、multicastは最大500人）
+LINE_MAX_MESSAGES = 5
+LINE_MAX_MULTICAST = 500
+DELIVERY_WORKERS = int(os.getenv("DELIVERY_WORKERS", "8"))
+DELIVERY_RETRIES = int(os.getenv("DELIVERY_RETRIES", "3"))
+
+# トークンバケットによる送信レート制限
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+push_bucket = TokenBucket(float(os.getenv("LINE_PUSH_RATE", "1000")), float(os.getenv("LINE_PUSH_BURST", "100")))
+multicast_bucket = TokenBucket(float(os.getenv("LINE_MULTICAST_RATE", "100")), float(os.getenv("LINE_MULTICAST_BURST", "10")))
+delivery_pool = ThreadPoolExecutor(max_workers=DELIVERY_WORKERS)
+# 直近の送信結果（/delivery-logで確認する）
+delivery_log = deque(maxlen=int(os.getenv("DELIVERY_LOG_SIZE", "1000")))
+
+@app.get("/delivery-log")
+async def delivery_log_endpoint(limit: int = 100, failed_only: bool = False):
+    entries = [r for r in list(delivery_log) if not failed_only or not r["ok"]]
+    return {
+        "total": len(delivery_log),
+        "failed": sum(1 for r in list(delivery_log) if not r["ok"]),
+        "entries": entries[::-1][:max(0, limit)],
+    }
+
+def _is_retryable(e: Exception):
+    status = getattr(e, "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(e, requests.exceptions.RequestException)
+
+# 1回分の送信（429・5xx・通信エラーは指数バックオフで再送）
+def _send_with_retry(user_ids, texts):
+    messages = [TextSendMessage(text=t) for t in texts]
+    for attempt in range(DELIVERY_RETRIES + 1):
+        try:
+            if len(user_ids) == 1:
+                push_bucket.acquire()
+                line_bot_api.push_message(user_ids[0], messages)
+            else:
+                multicast_bucket.acquire()
+                line_bot_api.multicast(user_ids, messages)
+            return {"users": len(user_ids), "messages": len(texts), "ok": True, "attempts": attempt + 1}
+        except Exception as e:
+            if attempt >= DELIVERY_RETRIES or not _is_retryable(e):
+                print(f"通知の送信に失敗しました（{len(user_ids)}人）:", e)
+                return {"users": len(user_ids), "messages": len(texts), "ok": False, "attempts": attempt + 1, "error": str(e)}
+            time.sleep(min(30, 0.5 * 2 ** attempt) * (1 + random.random()))
+
+# 通知をユーザーごとにまとめて送信する
+# 同じ内容を受け取るユーザーが複数いる場合はmulticastで1回にまとめる
+def deliver_notifications(alerts):
+    per_user = {}
+    for user_id, text in alerts:
+        texts = per_user.setdefault(user_id, [])
+        if text not in texts:
+            texts.append(text)
+
+    groups = {}
+    for user_id, texts in per_user.items():
+        groups.setdefault(tuple(texts), []).append(user_id)
+
+    # 5件を超えるメッセージは順番が入れ替わらないよう同じタスク内で順に送る
+    def _send_group(user_ids, texts):
+        return [_send_with_retry(user_ids, list(texts[i:i + LINE_MAX_MESSAGES]))
+                for i in range(0, len(texts), LINE_MAX_MESSAGES)]
+
+    futures = []
+    for texts, user_ids in groups.items():
+        for j in range(0, len(user_ids), LINE_MAX_MULTICAST):
+            futures.append(delivery_pool.submit(_send_group, user_ids[j:j + LINE_MAX_MULTICAST], texts))
+
+    results = [r for f in futures for r in f.result()]
+    delivery_log.extend({**r, "at": time.time()} for r in results)
+    return {
+        "alerts": len(alerts),
+        "users": len(per_user),
+        "requests": len(results),
+        "failed_requests": sum(1 for r in results if not r["ok"]),
+    }
+
+# ストリーミング用の価格ソース（Yahooのリアルタイム配信）
+class YahooStreamSource:
+    def __init__(self):
+        self._ws = None
+        self._tickers = set()
+        self._lock = threading.Lock()
+
+    # 監視中の銘柄に合わせて購読を更新する
+    def subscribe(self, tickers):
+        tickers = set(tickers)
+        with self._lock:
+            added, removed = tickers - self._tickers, self._tickers - tickers
+            self._tickers = tickers
+            ws = self._ws
+        if ws is not None:
+            if added:
+                ws.subscribe(list(added))
+            if removed:
+                ws.unsubscribe(list(removed))
+
+    def run(self, on_tick):
+        while True:
+            try:
+                with get_yf().WebSocket(verbose=False) as ws:
+                    with self._lock:
+                        self._ws = ws
+                        tickers = list(self._tickers)
+                    if tickers:
+                        ws.subscribe(tickers)
+                    ws.listen(lambda m: on_tick(m.get("id"), m.get("price"), m.get("previous_close")))
+            except Exception as e:
+                print("株価ストリームの接続エラー:", e)
+            with self._lock:
+                self._ws = None
+            time.sleep(5)
+
+# ローカル確認用の価格ソース（CSV: ticker,price,previous_close,delay を順に再生する）
+class ReplaySource:
+    def __init__(self, path: str, speed: float = 1.0):
+        self.path = path
+        self.speed = speed
+        self._tickers = set()
+
+    def subscribe(self, tickers):
+        self._tickers = set(tickers)
+
+    def run(self, on_tick):
+        with open(self.path, encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                time.sleep(float(row.get("delay") or 0) / self.speed)
+                if row["ticker"] in self._tickers:
+                    prev_close = row.get("previous_close")
+                    on_tick(row["ticker"], float(row["price"]), float(prev_close) if prev_close else None)
+        print("株価の再生が終了しました:", self.path)
+
+# 価格ティックを受け取るたびにしきい値インデックスで判定し、すぐに通知する
+class StreamingEngine:
+    def __init__(self, source, refresh_interval: float):
+        self.source = source
+        self.refresh_interval = refresh_interval
+        self._alert_pool = ThreadPoolExecutor(max_workers=2)
+        self._started = False
+        self.leader = False
+        self.ticks = 0
+        self.alerts = 0
+        self.last_tick_at = None
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        try:
+            self.refresh()
+        except Exception as e:
+            print("ストリーミングの通知設定読み込みに失敗しました（次の更新で再試行します）:", e)
+        threading.Thread(target=self.source.run, args=(self._on_tick,), daemon=True, name="price-stream").start()
+        threading.Thread(target=self._refresh_loop, daemon=True, name="price-stream-refresh").start()
+
+    # 複数のワーカーで動かしても通知を送るのは1つだけにする
+    # 全ワーカーがティックを判定して通知済み状態を揃えておき、リースを持つワーカーだけが送る
+    # リースはrefreshのたびに取り直して延長し、持ち主が止まったら期限切れ後に別のワーカーが引き継ぐ
+    def renew_lease(self):
+        try:
+            claimed, _, _ = lease_store.claim(STREAM_LEASE_SHARD)
+        except Exception as e:
+            print("ストリーミングのリース更新に失敗しました:", e)
+            claimed = False
+        if claimed != self.leader:
+            print("ストリーミングの通知送信を担当します" if claimed else "ストリーミングの通知送信を他のワーカーに任せます")
+        self.leader = claimed
+
+    # 通知設定を読み直し、誰かが監視している銘柄だけを購読する
+    def refresh(self):
+        self.renew_lease()
+        rows = notification_mirror.refresh()
+        threshold_index.sync([n for n in rows if n["condition_type"] in PRICE_CONDITION_TYPES])
+        window_tickers = {n.get("ticker") or "7203.T" for n in rows if n["condition_type"] in WINDOW_CONDITION_TYPES}
+        price_history.watch(window_tickers)
+        self.source.subscribe(set(threshold_index.tickers()) | window_tickers)
+        price_history.flush()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                print("ストリーミングの通知設定更新に失敗しました:", e)
+
+    def _on_tick(self, ticker, price, prev_close):
+        if not ticker or price is None:
+            return
+        self.ticks += 1
+        self.last_tick_at = time.time()
+        price_history.record(ticker, price, self.last_tick_at)
+
+        # チャットでの検索にも最新の値が使われるようにキャッシュ済みの株価を更新する
+        # 期限は延ばさない（前日終値や高値・安値などはTTLが来たらYahooから取り直す）
+        info = quote_cache.get(ticker)
+        if info is not None:
+            quote_cache.replace(ticker, {**info, "currentPrice": price})
+            prev_close = prev_close or info.get("previousClose")
+
+        triggered = threshold_index.evaluate(ticker, price, prev_close)
+        if triggered and self.leader:
+            self.alerts += len(triggered)
+            self._alert_pool.submit(self._send_alerts, ticker, price, triggered)
+
+    def _send_alerts(self, ticker, price, triggered):
+        try:
+            info = {**fetch_quote(ticker), "currentPrice": price}
+        except Exception as e:
+            print(f"株価取得失敗 ({ticker}):", e)
+            info = {"currentPrice": price}
+        deliver_notifications([
+            (n["line_user_id"], format_stock_info(ticker, info, diff_percent)) for n, diff_percent in triggered
+        ])
+
+    def stats(self):
+        return {
+            "leader": self.leader,
+            "subscribed": len(threshold_index.tickers()),
+            "ticks": self.ticks,
+            "alerts": self.alerts,
+            "last_tick_at": self.last_tick_at,
+        }
+
+# STREAMING_MODE=yahoo でYahooのリアルタイム配信、replay:<CSVのパス> でローカル再生を使う
+def create_streaming_engine():
+    mode = os.getenv("STREAMING_MODE", "")
+    if not mode:
+        return None
+    if mode == "yahoo":
+        source = YahooStreamSource()
+    elif mode.startswith("replay:"):
+        source = ReplaySource(mode[len("replay:"):], float(os.getenv("REPLAY_SPEED", "1")))
+    else:
+        print("不明なSTREAMING_MODEです:", mode)
+        return None
+    return StreamingEngine(source, float(os.getenv("STREAM_REFRESH_SECONDS", "10")))
+
+streaming_engine = create_streaming_engine()
+
+# ポートを開くまでは重い処理を始めない（起動フックの時点ではまだ接続を受け付けていない）
+# uvicornが受け付けを始めたことを自分のポートへの接続で確かめる。PORTはRenderが設定するポート番号
+SERVER_PORT = int(os.getenv("PORT", "8000"))
+SERVER_READY_TIMEOUT = float(os.getenv("SERVER_READY_TIMEOUT", "30"))
+
+def wait_until_serving():
+    deadline = time.monotonic() + SERVER_READY_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", SERVER_PORT), timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    print(f"{SERVER_READY_TIMEOUT:.0f}秒以内にポート{SERVER_PORT}で受け付けが始まりませんでした。待たずに続けます")
+    return False
+
+def _start_streaming_engine():
+    wait_until_serving()
+    try:
+        streaming_engine.start()
+    except Exception as e:
+        print("ストリーミングの開始に失敗しました:", e)
+
+@app.on_event("startup")
+def start_streaming_engine():
+    if streaming_engine is not None:
+        threading.Thread(target=_start_streaming_engine, daemon=True, name="price-stream-start").start()
+
+@app.get("/stream-stats")
+async def stream_stats():
+    if streaming_engine is None:
+        return {"status": "disabled"}
+    return streaming_engine.stats()
+
+# ポートを開いた後に、重いモジュールの読み込みとクライアントの作成を裏で済ませておく
+def warm_up():
+    wait_until_serving()
+    started = time.perf_counter()
+    try:
+        get_yf()
+        for client in (supabase, line_bot_api):
+            if isinstance(client, LazyClient):
+                client.get()
+    except Exception as e:
+        print("ウォームアップに失敗しました:", e)
+    print(f"ウォームアップ完了: {time.perf_counter() - started:.2f}秒")
+
+@app.on_event("startup")
+def start_warm_up():
+    threading.Thread(target=warm_up, daemon=True, name="warm-up").start()
+
+# 起動時と遅延読み込みするモジュールの読み込み時間を計測する（python -X importtimeの結果を集計）
+def report_import_times(top: int = 15):
+    # 戻り値: (合計ms, [(ms, moduleが直接読み込んだモジュール)...])
+    def _measure(module):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        children = []
+        for line in result.stderr.splitlines():
+            match = re.match(r"import time:\s+\d+ \|\s+(\d+) \|( +)(\S+)", line)
+            if not match:
+                continue
+            ms, depth, name = int(match[1]) / 1000, len(match[2]), match[3]
+            if depth == 3:
+                children.append((ms, name))
+            elif depth == 1:
+                if name == module:
+                    return ms, sorted(children, reverse=True)
+                children = []
+        return 0.0, []
+
+    total, children = _measure("main")
+    print(f"main.pyの読み込み: 合計{total:.1f}ms")
+    for ms, module in children[:top]:
+        print(f"  {ms:8.1f}ms  {module}")
+    print("遅延読み込みするモジュール（初回利用時またはウォームアップ時）:")
+    for module in ("yfinance", "supabase"):
+        print(f"  {_measure(module)[0]:8.1f}ms  {module}")
+
+if __name__ == "__main__":
+    # 銘柄辞書の作成: python main.py build-symbol-index listings.csv symbols.idx
+    if len(sys.argv) == 4 and sys.argv[1] == "build-symbol-index":
+        count = build_symbol_index(sys.argv[2], sys.argv[3])
+        print(f"{count}件のキーを書き出しました: {sys.argv[3]}")
+
+    # 起動時間の計測: python main.py import-times
+    if len(sys.argv) == 2 and sys.argv[1] == "import-times":
+        report_import_times()
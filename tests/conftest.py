@@ -0,0 +1,12 @@
+import os
+import sys
+
+# main.pyは読み込み時に環境変数を参照するので、テスト用のダミー値を先に入れておく
+os.environ.setdefault("SUPABASE_URL", "http://localhost:1")
+os.environ.setdefault("SUPABASE_KEY", "a.b.c")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "test")
+os.environ.setdefault("SYMBOL_INDEX_PATH", "")
+os.environ.setdefault("CHECK_LEASE_STORE", "memory")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,189 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+import main
+
+
+def _row(id, cond_type, user="U1", ticker="7203.T", **detail):
+    return {
+        "id": id,
+        "line_user_id": user,
+        "ticker": ticker,
+        "condition_type": cond_type,
+        "condition_detail": json.dumps({"type": cond_type, **detail}, ensure_ascii=False),
+    }
+
+
+def _at(hour, minute=0, day=16):
+    return datetime(2026, 10, day, hour, minute, tzinfo=main.JST)
+
+
+# --- NotificationScheduler ---
+
+def test_scheduler_fires_daily_row_once_when_due():
+    scheduler = main.NotificationScheduler()
+    row = _row(1, "daily", times=["9時00分"])
+    scheduler.sync([row], _at(8, 59))
+    assert scheduler.pop_due(_at(8, 59)) == []
+    assert scheduler.pop_due(_at(9, 0)) == [row]
+    assert scheduler.pop_due(_at(9, 1)) == []
+    assert scheduler.pop_due(_at(9, 0, day=17)) == [row]
+
+
+def test_scheduler_catches_up_missed_times_from_last_run():
+    # 前回の実行が8:30で次の実行が9:10なら、間の9:00の通知を1回だけ送る
+    scheduler = main.NotificationScheduler(_at(8, 30))
+    row = _row(1, "daily", times=["9時00分", "9時05分"])
+    scheduler.sync([row], _at(9, 10))
+    assert scheduler.pop_due(_at(9, 10)) == [row]
+    assert scheduler.last_run == _at(9, 10)
+
+
+def test_scheduler_skips_times_older_than_catchup_window():
+    scheduler = main.NotificationScheduler(_at(6, 0))
+    row = _row(1, "daily", times=["7時00分"])
+    scheduler.sync([row], _at(7, 0) + timedelta(minutes=main.SCHEDULE_CATCHUP_MINUTES + 1))
+    assert scheduler.pop_due(_at(7, 0) + timedelta(minutes=main.SCHEDULE_CATCHUP_MINUTES + 1)) == []
+
+
+def test_scheduler_drops_removed_and_reschedules_changed_rows():
+    scheduler = main.NotificationScheduler(_at(8, 0))
+    removed = _row(1, "daily", times=["9時00分"])
+    changed = _row(2, "daily", times=["9時00分"])
+    scheduler.sync([removed, changed], _at(8, 0))
+    changed = _row(2, "daily", times=["10時00分"])
+    scheduler.sync([changed], _at(8, 30))
+    assert scheduler.pop_due(_at(9, 30)) == []
+    assert scheduler.pop_due(_at(10, 0)) == [changed]
+
+
+def test_scheduler_weekly_uses_weekday():
+    scheduler = main.NotificationScheduler(_at(0, 0))
+    row = _row(1, "weekly", day="月曜", time="9時00分")  # 2026-10-16は金曜
+    scheduler.sync([row], _at(0, 0))
+    assert scheduler.pop_due(_at(9, 0)) == []
+    assert scheduler.pop_due(_at(9, 0, day=19)) == [row]
+
+
+# --- ThresholdIndex ---
+
+@pytest.fixture
+def index():
+    index = main.ThresholdIndex()
+    index.add(_row(1, "price_over", price=100))
+    index.add(_row(2, "price_over", price=120))
+    index.add(_row(3, "price_under", price=90))
+    index.add(_row(4, "percent_up", percent=3))
+    index.add(_row(5, "percent_down", percent=3))
+    return index
+
+
+def _ids(results):
+    return sorted(row["id"] for row, _ in results)
+
+
+def test_threshold_index_matches_by_bisect(index):
+    assert _ids(index.evaluate("7203.T", 110, 110)) == [1]
+    assert _ids(index.evaluate("7203.T", 130, 110)) == [2, 4]
+    assert _ids(main.ThresholdIndex().evaluate("7203.T", 130, 110)) == []
+
+
+def test_threshold_index_price_under_and_percent_down(index):
+    results = index.evaluate("7203.T", 85, 100)
+    assert _ids(results) == [3, 5]
+    assert dict((row["id"], diff) for row, diff in results)[5] == pytest.approx(-15.0)
+
+
+def test_threshold_index_fires_once_per_crossing(index):
+    assert _ids(index.evaluate("7203.T", 110, 110)) == [1]
+    assert _ids(index.evaluate("7203.T", 111, 111)) == []
+    assert _ids(index.evaluate("7203.T", 95, 95)) == []
+    assert _ids(index.evaluate("7203.T", 105, 105)) == [1]
+
+
+def test_threshold_index_keeps_percent_state_without_previous_close(index):
+    assert _ids(index.evaluate("7203.T", 105, 100)) == [1, 4]
+    assert _ids(index.evaluate("7203.T", 105, None)) == []
+    assert _ids(index.evaluate("7203.T", 105, 100)) == []
+
+
+def test_threshold_index_accept_limits_rows_and_state(index):
+    only_first = lambda n: n["id"] == 1
+    assert _ids(index.evaluate("7203.T", 130, 110, accept=only_first)) == [1]
+    # acceptの対象外だった行の状態は変えていないので、後から判定すれば通知される
+    assert _ids(index.evaluate("7203.T", 130, 110)) == [2, 4]
+
+
+def test_threshold_index_remove_user_and_sync(index):
+    index.add(_row(6, "price_over", user="U2", price=100))
+    index.remove_user("U1")
+    assert _ids(index.evaluate("7203.T", 130, 100)) == [6]
+    index.sync([_row(7, "price_over", user="U3", price=100)])
+    assert len(index) == 1
+
+
+def test_compile_condition_rejects_non_object_detail():
+    assert main.compile_condition("price_over", "5") is None
+    assert main.compile_condition("daily", "null") is None
+
+
+# --- リースと通知済み状態の引き継ぎ ---
+
+@pytest.fixture
+def workers(monkeypatch):
+    monkeypatch.setattr(main, "lease_store", main.MemoryLeaseStore())
+    monkeypatch.setattr(main, "streaming_engine", None)
+    monkeypatch.setattr(main, "CHECK_LEASE_SECONDS", 60)
+
+    def switch(worker_id):
+        monkeypatch.setattr(main, "WORKER_ID", worker_id)
+        monkeypatch.setattr(main, "threshold_index", main.ThresholdIndex())
+        monkeypatch.setattr(main, "window_evaluator", main.WindowAlertEvaluator())
+    return switch
+
+
+def test_lease_is_exclusive_until_released(workers):
+    workers("A")
+    assert main.lease_store.claim(0)[0]
+    workers("B")
+    assert main.lease_store.claim(0) == (False, None, None)
+    workers("A")
+    main.lease_store.release(0, _at(9, 0), {"fired": [], "seen": []})
+    workers("B")
+    claimed, last_run, state = main.lease_store.claim(0)
+    assert claimed and last_run == _at(9, 0) and state == {"fired": [], "seen": []}
+
+
+def test_alert_state_hands_over_between_workers(workers):
+    rows = [_row(1, "price_over", price=100), _row(2, "price_over", price=200)]
+
+    workers("A")
+    main.lease_store.claim(0)
+    main.threshold_index.sync(rows)
+    assert _ids(main.threshold_index.evaluate("7203.T", 150, 150)) == [1]
+    main.lease_store.release(0, _at(9, 0), main.export_alert_state(rows))
+
+    workers("B")
+    claimed, _, state = main.lease_store.claim(0)
+    main.threshold_index.sync(rows)
+    main.restore_alert_state(rows, state)
+    assert claimed
+    assert _ids(main.threshold_index.evaluate("7203.T", 150, 150)) == []
+    assert _ids(main.threshold_index.evaluate("7203.T", 250, 150)) == [2]
+
+
+def test_alert_state_survives_rows_without_id(workers):
+    row = _row(None, "price_over", price=100)
+    del row["id"]
+
+    workers("A")
+    main.threshold_index.sync([row])
+    main.threshold_index.evaluate("7203.T", 150, 150)
+    state = json.loads(json.dumps(main.export_alert_state([row])))
+
+    workers("B")
+    main.threshold_index.sync([row])
+    main.restore_alert_state([row], state)
+    assert main.threshold_index.evaluate("7203.T", 150, 150) == []